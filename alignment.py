@@ -0,0 +1,209 @@
+import numpy as np
+import scipy.ndimage
+
+# Cost of matching a voiced frame against an unvoiced one, and the cap on pitch distance, in semitones
+UNVOICED_MISMATCH_COST = 3.0
+MAX_SEMITONE_COST = 6.0
+# Cost of leaving a note unmatched (a missed or an extra note), in semitones
+NOTE_GAP_COST = 2.0
+# Cost of pairing notes whose onsets are a second apart once the take's lag is allowed for, in
+# semitones. Without it a take sung off-key pairs each note with whichever note is nearest in pitch,
+# however far away in time.
+NOTE_TIMING_COST = 4.0
+# Cost of a horizontal or vertical DTW step, in semitones. Without it the path bends freely to pair
+# up frames that happen to match, and hides a take's pitch error instead of only its timing; with it
+# the path leaves the diagonal only where a timing offset pays for itself over many frames.
+STEP_PENALTY = 0.5
+
+def pitch_to_semitones(pitch):
+    # Converts Hz to semitones relative to A4, with NaN for unvoiced (zero) frames.
+    semitones = np.full(len(pitch), np.nan)
+    voiced = pitch > 0
+    semitones[voiced] = 12 * np.log2(pitch[voiced] / 440.0)
+    return semitones
+
+def smooth_semitones(semitones, size):
+    # Median-smooths a semitone contour over size frames, so vibrato doesn't steer the alignment.
+    # Frames whose window is mostly unvoiced keep their own value.
+    if size <= 1:
+        return semitones
+    voiced = ~np.isnan(semitones)
+    # Shift so every voiced value is positive and 0 can stand for unvoiced, as in segment_notes
+    offset = 1.0 - np.min(semitones[voiced]) if np.any(voiced) else 0.0
+    shifted = np.where(voiced, semitones + offset, 0.0)
+    smoothed = scipy.ndimage.median_filter(shifted, size=size, mode='nearest')
+    return np.where(voiced & (smoothed > 0), smoothed - offset, semitones)
+
+def _frame_cost(ref_value, user_values):
+    # Distance between one reference frame and a run of user frames (all in semitones, NaN = unvoiced).
+    ref_voiced = not np.isnan(ref_value)
+    user_voiced = ~np.isnan(user_values)
+    if not ref_voiced:
+        return np.where(user_voiced, UNVOICED_MISMATCH_COST, 0.0)
+    distance = np.minimum(np.abs(np.nan_to_num(user_values) - ref_value), MAX_SEMITONE_COST)
+    return np.where(user_voiced, distance, UNVOICED_MISMATCH_COST)
+
+def dtw_align(ref_pitch, user_pitch, band_radius=130, step_penalty=STEP_PENALTY, smoothing_frames=1):
+    # Aligns two pitch tracks with Sakoe-Chiba banded DTW and returns the warping path.
+    #
+    # Both contours are median-smoothed over smoothing_frames first, and every horizontal or vertical
+    # step costs step_penalty on top of the frame cost, so the path follows timing, not vibrato.
+    # Only cells within band_radius frames of the diagonal are evaluated, so time and memory grow
+    # linearly with song length. Both tracks are assumed to start together; the path may end early
+    # on either side, so a take that covers only part of the song (or runs past it) still aligns.
+    # Each row is solved in a vectorized pass: the horizontal-step recurrence
+    # D[j] = min(A[j], D[j-1] + c[j] + p) is a running minimum over prefix sums of the penalised
+    # cost.
+    #
+    # Returns an int array of shape (path_length, 2) holding (reference frame, user frame) pairs.
+    ref_st = smooth_semitones(pitch_to_semitones(np.asarray(ref_pitch)), smoothing_frames)
+    user_st = smooth_semitones(pitch_to_semitones(np.asarray(user_pitch)), smoothing_frames)
+    n_user = len(user_st)
+    n_ref = min(len(ref_st), n_user + band_radius)
+    if n_ref == 0 or n_user == 0:
+        return np.zeros((0, 2), dtype=int)
+
+    width = 2 * band_radius + 1
+    # Band for row i covers user frames i - band_radius ... i + band_radius
+    acc = np.full((n_ref, width), np.inf, dtype=np.float32)
+
+    for i in range(n_ref):
+        low = i - band_radius
+        first = max(low, 0)
+        last = min(i + band_radius, n_user - 1)
+        if first > last:
+            continue
+        cols = slice(first - low, last - low + 1)
+
+        cost = _frame_cost(ref_st[i], user_st[first:last + 1])
+        if i == 0:
+            # Paths start at (0, 0)
+            best_previous = np.full(len(cost), np.inf)
+            if first == 0:
+                best_previous[0] = 0.0
+        else:
+            # With a diagonal band the cell above is one column to the right in the previous row
+            previous = acc[i - 1]
+            up = np.full(width, np.inf)
+            up[:-1] = previous[1:]
+            best_previous = np.minimum(up + step_penalty, previous)[cols]
+
+        entry = cost + best_previous
+        prefix = np.cumsum(cost + step_penalty)
+        acc[i, cols] = prefix + np.minimum.accumulate(entry - prefix)
+
+    # Open end: finish on the last user frame or the last reference row, whichever is cheaper per step
+    last_col = (n_user - 1) - (np.arange(n_ref) - band_radius)
+    in_band = (last_col >= 0) & (last_col < width)
+    end_candidates = [(i, n_user - 1) for i in np.flatnonzero(in_band)]
+    last_row_first = max(n_ref - 1 - band_radius, 0)
+    last_row_last = min(n_ref - 1 + band_radius, n_user - 1)
+    end_candidates += [(n_ref - 1, j) for j in range(last_row_first, last_row_last + 1)]
+
+    def normalized(cell):
+        i, j = cell
+        return acc[i, j - i + band_radius] / (i + j + 2)
+
+    # Ties go to the longer path
+    end = min(end_candidates, key=lambda cell: (normalized(cell), -sum(cell)))
+    if not np.isfinite(normalized(end)):
+        return np.zeros((0, 2), dtype=int)
+
+    return _backtrack(acc, end, band_radius, step_penalty)
+
+def _backtrack(acc, end, band_radius, step_penalty=0.0):
+    # Walks back from the end cell to (0, 0) following the cheapest predecessor, step penalty included.
+    def value(i, j):
+        k = j - i + band_radius
+        if i < 0 or j < 0 or k < 0 or k >= acc.shape[1]:
+            return np.inf
+        return acc[i, k]
+
+    i, j = end
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        steps = (((i - 1, j - 1), 0.0), ((i - 1, j), step_penalty), ((i, j - 1), step_penalty))
+        (i, j), _ = min(steps, key=lambda step: value(*step[0]) + step[1])
+        path.append((i, j))
+    return np.array(path[::-1], dtype=int)
+
+def reference_to_user_index(path, n_ref):
+    # For every aligned reference frame, the first user frame it was matched to.
+    if len(path) == 0:
+        return np.zeros(0, dtype=int)
+    n_aligned = min(path[-1, 0] + 1, n_ref)
+    first_match = np.searchsorted(path[:, 0], np.arange(n_aligned))
+    return path[first_match, 1]
+
+def warp_features(user_features, path, n_ref):
+    # Resamples user features onto the reference timeline using a warping path.
+    n_user = len(user_features['pitch'])
+    user_index = reference_to_user_index(path, n_ref)
+    warped = {}
+    for name, value in user_features.items():
+        value = np.asarray(value)
+        if value.ndim > 0 and value.shape[-1] == n_user:
+            warped[name] = value[..., user_index]
+        else:
+            warped[name] = value
+    return warped
+
+def _note_pair_costs(ref_midi, user_midi, ref_onsets, user_onsets, timing_cost):
+    # Cost of pairing every reference note with every user note: pitch distance plus onset distance,
+    # each capped at MAX_SEMITONE_COST.
+    cost = np.minimum(np.abs(user_midi[None, :] - ref_midi[:, None]), MAX_SEMITONE_COST)
+    if ref_onsets is not None and user_onsets is not None:
+        seconds = np.abs(np.asarray(user_onsets, dtype=np.float64)[None, :]
+                         - np.asarray(ref_onsets, dtype=np.float64)[:, None])
+        cost += np.minimum(timing_cost * seconds, MAX_SEMITONE_COST)
+    return cost
+
+def align_notes(ref_midi, user_midi, ref_onsets=None, user_onsets=None, gap_cost=NOTE_GAP_COST,
+                timing_cost=NOTE_TIMING_COST):
+    # Aligns two note sequences (MIDI pitches) with a global edit-distance alignment.
+    #
+    # A note pair costs its pitch distance in semitones plus, when onsets are given, timing_cost per
+    # second between them (each capped at MAX_SEMITONE_COST); a note left unmatched on either side
+    # costs gap_cost. ref_onsets are where each reference note is expected in the take, e.g. mapped
+    # through a DTW path, so only a take's own timing errors cost anything. Sequences hold one entry
+    # per note rather than per frame, so the full table is small. Each row is solved in one vectorized
+    # pass: the horizontal-gap recurrence D[j] = min(A[j], D[j-1] + g) is a running minimum of
+    # A[j] - g * j.
+    #
+    # As with dtw_align the end is open: notes after the last one either side reached are left out of
+    # the path rather than counted as missed or extra, so a take covering part of the song still aligns.
+    #
+    # Returns an int array of shape (path_length, 2) of (reference note, user note) pairs, in order,
+    # with -1 on the side that has no note (a missed note when the user index is -1, an extra one
+    # otherwise).
+    ref_midi = np.asarray(ref_midi, dtype=np.float64)
+    user_midi = np.asarray(user_midi, dtype=np.float64)
+    n_ref, n_user = len(ref_midi), len(user_midi)
+    pair_costs = _note_pair_costs(ref_midi, user_midi, ref_onsets, user_onsets, timing_cost)
+
+    gaps = gap_cost * np.arange(n_user + 1)
+    acc = np.empty((n_ref + 1, n_user + 1))
+    acc[0] = gaps
+    for i in range(1, n_ref + 1):
+        entry = np.empty(n_user + 1)
+        entry[0] = acc[i - 1, 0] + gap_cost
+        entry[1:] = np.minimum(acc[i - 1, :-1] + pair_costs[i - 1], acc[i - 1, 1:] + gap_cost)
+        acc[i] = gaps + np.minimum.accumulate(entry - gaps)
+
+    # Finish on the last reference or the last user note, whichever is cheaper; ties go to the longer path
+    end_candidates = [(i, n_user) for i in range(n_ref + 1)] + [(n_ref, j) for j in range(n_user + 1)]
+    i, j = min(end_candidates, key=lambda cell: (acc[cell], -sum(cell)))
+
+    # Walk back from the end, preferring matches over gaps on ties
+    pairs = []
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and np.isclose(acc[i, j], acc[i - 1, j - 1] + pair_costs[i - 1, j - 1]):
+            i, j = i - 1, j - 1
+            pairs.append((i, j))
+        elif i > 0 and np.isclose(acc[i, j], acc[i - 1, j] + gap_cost):
+            i -= 1
+            pairs.append((i, -1))
+        else:
+            j -= 1
+            pairs.append((-1, j))
+    return np.array(pairs[::-1], dtype=int).reshape(-1, 2)
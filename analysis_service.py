@@ -0,0 +1,387 @@
+"""Analysis jobs run off the Streamlit script thread.
+
+The analysis page submits a job and polls it, so the page stays responsive while the take is
+analysed. A fixed set of job threads runs the pipeline and fans the DSP out to the shared process
+pool. All jobs wait in one queue. Each user may have only one job running and a couple waiting, so
+a burst from one session cannot starve the others. Total work is bounded by the number of cores,
+not by the number of open sessions.
+"""
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import wait
+
+import numpy as np
+
+from audio_analysis import (LONG_RECORDING_SECONDS, STREAM_BLOCK_FRAMES, HOP_LENGTH, ANALYSIS_SR, load_audio,
+                            audio_duration, analysis_params, reference_pitch_range, submit_features,
+                            collect_features, compare_takes, stream_features, feature_blocks,
+                            compare_take_streams, give_feedback, skipped_fraction)
+from alignment import warp_features
+from instrumentation import span
+from scoring import rank_takes, best_by_phrase
+from separation import separation_params, isolate_vocals, cached_vocals, cache_vocals
+
+logger = logging.getLogger("melody_mentor.analysis")
+
+# Jobs analysed at once. Each fans its chunks out to the process pool, so a few keep every core busy
+MAX_RUNNING_JOBS = int(os.environ.get("MELODY_MENTOR_ANALYSIS_JOBS", max(2, (os.cpu_count() or 2) // 2)))
+MAX_RUNNING_PER_USER = 1
+MAX_QUEUED_PER_USER = 2
+MAX_QUEUED_JOBS = 100
+# Takes compared with one reference in a single job. They share the reference's analysis, but each
+# still costs its own extraction, alignment and charts.
+MAX_TAKES = int(os.environ.get("MELODY_MENTOR_MAX_TAKES", 8))
+# How often a running job re-checks its chunks for progress and cancellation
+PROGRESS_POLL_SECONDS = 0.25
+# Seconds of audio per streamed block, for progress through long recordings
+STREAM_BLOCK_SECONDS = STREAM_BLOCK_FRAMES * HOP_LENGTH / ANALYSIS_SR
+
+
+class AnalysisRejected(Exception):
+    """Raised by submit() when the queue or the user's allowance is full"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been cancelled"""
+
+
+class Job:
+    """One submitted analysis; its status, stage and progress are updated by the job thread as it runs"""
+
+    def __init__(self, user_id, inputs, meta):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.inputs = inputs
+        # Caller's bookkeeping, e.g. the song title to save the analysis under
+        self.meta = meta
+        self.status = "queued"
+        self.stage = "Waiting for a free analysis slot"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def queue_seconds(self):
+        return (self.started_at or time.monotonic()) - self.submitted_at
+
+    def report(self, stage, progress):
+        """Record progress; raises JobCancelled once the job has been cancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+        self.stage = stage
+        self.progress = min(1.0, max(self.progress, progress))
+
+    def release_inputs(self):
+        # The uploaded bytes are not needed once the job has finished
+        self.inputs = None
+
+
+class AnalysisService:
+    """Bounded pool of job threads serving one FIFO queue with per-user limits"""
+
+    def __init__(self, executor, feature_cache, max_running=MAX_RUNNING_JOBS,
+                 max_running_per_user=MAX_RUNNING_PER_USER, max_queued_per_user=MAX_QUEUED_PER_USER,
+                 max_queued=MAX_QUEUED_JOBS, on_done=None):
+        self.executor = executor
+        self.feature_cache = feature_cache
+        # Called on the job thread with every job that succeeded, before it is marked done, so work
+        # such as saving the results doesn't depend on the user keeping the page open
+        self.on_done = on_done
+        self.max_running_per_user = max_running_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.running = Counter()
+        self.completed = 0
+        self.threads = [threading.Thread(target=self._run, name=f"analysis-job-{i}", daemon=True)
+                        for i in range(max_running)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, user_id, inputs, **meta):
+        """Queue an analysis and return its Job, or raise AnalysisRejected"""
+        if len(inputs['takes']) > MAX_TAKES:
+            raise AnalysisRejected(f"Please compare at most {MAX_TAKES} takes at a time.")
+        with self.condition:
+            if len(self.queue) >= self.max_queued:
+                raise AnalysisRejected("The server is busy right now. Please try again in a minute.")
+            if sum(1 for job in self.queue if job.user_id == user_id) >= self.max_queued_per_user:
+                raise AnalysisRejected("You already have analyses waiting. Please wait for them to finish.")
+            job = Job(user_id, inputs, meta)
+            self.queue.append(job)
+            self.condition.notify()
+        return job
+
+    def position(self, job):
+        """1-based place in the queue of a job still waiting, else None"""
+        with self.condition:
+            for place, queued in enumerate(self.queue, 1):
+                if queued is job:
+                    return place
+        return None
+
+    def cancel(self, job):
+        """Stop a job: a waiting one is dropped, a running one stops at its next progress report"""
+        job.cancelled = True
+        with self.condition:
+            if job in self.queue:
+                self.queue.remove(job)
+                job.status = "cancelled"
+                job.finished_at = time.monotonic()
+                job.release_inputs()
+
+    def _next_job(self):
+        # Oldest waiting job whose user is below the running limit; called with the condition held
+        for job in self.queue:
+            if self.running[job.user_id] < self.max_running_per_user:
+                return job
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                self.queue.remove(job)
+                self.running[job.user_id] += 1
+                job.status = "running"
+                job.started_at = time.monotonic()
+            try:
+                job.result = analyze(job, self.executor, self.feature_cache)
+                if self.on_done is not None:
+                    try:
+                        self.on_done(job)
+                    except Exception:
+                        # The results are still shown; only the follow-up work is lost
+                        logger.exception("Completion of analysis %s failed", job.id)
+                job.status = "done"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                logger.exception("Analysis %s failed", job.id)
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.monotonic()
+                job.release_inputs()
+                with self.condition:
+                    self.running[job.user_id] -= 1
+                    self.completed += 1
+                    # A job held back by its user's limit may now be runnable
+                    self.condition.notify_all()
+
+
+def _wait_for_chunks(job, pending, start, end, stage="Analysing pitch, volume and tone"):
+    # Reports chunk completion as progress between start and end, and drops the chunks on cancellation
+    remaining = set(pending)
+    while remaining:
+        _, remaining = wait(remaining, timeout=PROGRESS_POLL_SECONDS)
+        try:
+            job.report(stage, start + (end - start) * (1 - len(remaining) / len(pending)))
+        except JobCancelled:
+            for future in remaining:
+                future.cancel()
+            raise
+
+
+def analyze(job, executor, feature_cache):
+    """Run one job's analysis and return what the results page shows.
+
+    job.inputs holds 'takes', a list of the user's recordings as dicts of 'name', 'bytes' and
+    'format' (the MIME type, for playback), and either 'ref_bytes' or 'library_song' (as loaded from
+    the ReferenceLibrary), plus the reference upload's 'ref_format'. An uploaded reference is replaced
+    by its vocal stem first when 'separation' names a method from separation.py; streamed long
+    recordings are compared without separation.
+
+    The reference is analysed once, however many takes there are. The result has one entry per take
+    under 'takes', in submission order, with 'ranking' listing them best first.
+    """
+    inputs = job.inputs
+    library_song = inputs.get('library_song')
+    ref_bytes = inputs.get('ref_bytes')
+    takes = inputs['takes']
+    separation = None if library_song else inputs.get('separation')
+
+    with span("analysis") as run:
+        job.report("Reading your recordings", 0.02)
+        with span("read_inputs"):
+            ref_duration = library_song['metadata']['duration'] if library_song else audio_duration(ref_bytes)
+            take_durations = [audio_duration(take['bytes']) for take in takes]
+            # Very long recordings are streamed instead of being decoded in full
+            durations = [ref_duration] + take_durations
+            long_recording = any(d is not None and d > LONG_RECORDING_SECONDS for d in durations)
+
+        if long_recording:
+            result = _analyze_streaming(job, ref_bytes, takes, take_durations, library_song)
+        else:
+            result = _analyze_in_memory(job, executor, feature_cache, ref_bytes, takes, library_song, separation)
+        result['ranking'] = rank_takes([take_result['comparison'] for take_result in result['takes']])
+    job.report("Done", 1.0)
+    result['run'] = run
+
+    skipped = [take_result['frames_skipped'] for take_result in result['takes']]
+    result['frames_skipped'] = {'reference': result.pop('ref_frames_skipped'), 'take': sum(skipped) / len(skipped)}
+    logger.info("Analysis %s: %d take(s); pitch tracking skipped %.0f%% of reference and %.0f%% of take frames "
+                "as silence", job.id, len(takes), 100 * result['frames_skipped']['reference'],
+                100 * result['frames_skipped']['take'])
+    # Playback uses the original recordings; the analysis PCM is mono and downsampled
+    result['ref_playback'] = ((library_song['source_path'], None) if library_song
+                              else (ref_bytes, inputs.get('ref_format')))
+    for take, take_result in zip(takes, result['takes']):
+        take_result['name'] = take['name']
+        take_result['playback'] = (take['bytes'], take.get('format'))
+    return result
+
+
+def _separate_reference(job, executor, feature_cache, ref_bytes, ref_audio, ref_sr, method):
+    # The reference's vocal stem, from the cache or separated in the process pool
+    stem = cached_vocals(feature_cache, ref_bytes, ref_sr, method)
+    if stem is None:
+        pending = [executor.submit(isolate_vocals, ref_audio, ref_sr, method)]
+        _wait_for_chunks(job, pending, 0.05, 0.3, "Isolating the vocals in the reference")
+        stem = pending[0].result()
+        cache_vocals(feature_cache, ref_bytes, ref_sr, stem, method)
+    return stem
+
+
+def _analyze_in_memory(job, executor, feature_cache, ref_bytes, takes, library_song, separation=None):
+    from plotting import prepare_plot_data, plot_data_key
+
+    # Every clip is decoded once, straight to the analysis rate, so none of them needs resampling
+    job.report("Decoding audio", 0.05)
+    with span("decode"):
+        if library_song:
+            ref_audio, ref_sr = library_song['audio'], library_song['metadata']['sr']
+        else:
+            ref_audio, ref_sr = load_audio(ref_bytes)
+        take_audio = [load_audio(take['bytes'], sr=ref_sr)[0] for take in takes]
+    if ref_audio is None or any(audio is None for audio in take_audio):
+        raise ValueError("Could not decode the audio files. Please check their formats and try again.")
+
+    # A mixed reference is analysed as its vocal stem, charts included
+    features_start = 0.1
+    if separation:
+        job.report("Isolating the vocals in the reference", 0.05)
+        with span("separation"):
+            ref_audio = _separate_reference(job, executor, feature_cache, ref_bytes, ref_audio, ref_sr, separation)
+        features_start = 0.3
+
+    # Reference features come from the library or the cache when this song was seen before. The
+    # chunks of the reference (on a miss) and of every take are analysed concurrently in one batch.
+    job.report("Analysing pitch, volume and tone", features_start)
+    with span("features"):
+        if library_song:
+            ref_features = library_song['features']
+        else:
+            params = analysis_params(ref_sr)
+            if separation:
+                params['separation'] = separation_params(ref_sr, separation)
+            ref_key = feature_cache.key(ref_bytes, params)
+            ref_features = feature_cache.get(ref_key)
+
+        ref_pending = []
+        if ref_features is None:
+            ref_pending = submit_features(executor, ref_audio, ref_sr)
+        pitch_range = reference_pitch_range(ref_audio, ref_sr, ref_features)
+        take_pending = [submit_features(executor, audio, ref_sr, pitch_range=pitch_range) for audio in take_audio]
+        _wait_for_chunks(job, ref_pending + [chunk for pending in take_pending for chunk in pending],
+                         features_start, 0.85)
+
+        if ref_pending:
+            ref_features = collect_features(ref_pending)
+            feature_cache.put(ref_key, ref_features)
+        take_features = [collect_features(pending) for pending in take_pending]
+
+    job.report("Comparing with the reference", 0.85)
+    with span("compare"):
+        ref_notes = library_song['notes'] if library_song else None
+        comparisons = compare_takes(ref_features, take_features, sr=ref_sr, ref_notes=ref_notes)
+        feedback = [give_feedback(comparison) for comparison in comparisons]
+        # Which take sang each phrase best, on the reference timeline
+        phrases = None
+        if len(takes) > 1:
+            warped = [warp_features(features, comparison['alignment_path'], len(ref_features['pitch']))
+                      if 'alignment_path' in comparison else features
+                      for features, comparison in zip(take_features, comparisons)]
+            phrases = best_by_phrase(ref_features, warped, ref_sr, HOP_LENGTH)
+
+    # The charts are drawn from data reduced to one point per pixel column
+    job.report("Preparing charts", 0.95)
+    results = []
+    with span("plot_data"):
+        for audio, features, comparison, take_feedback in zip(take_audio, take_features, comparisons, feedback):
+            plot_data = prepare_plot_data(ref_audio, ref_sr, audio, ref_sr, ref_features, features,
+                                          comparison.get('alignment_path'))
+            results.append({
+                'comparison': comparison,
+                'feedback': take_feedback,
+                'plot_data': plot_data,
+                'plot_key': plot_data_key(plot_data),
+                'frames_skipped': skipped_fraction(features),
+            })
+
+    return {
+        'takes': results,
+        'phrases': phrases,
+        'streamed': False,
+        'ref_frames_skipped': skipped_fraction(ref_features),
+    }
+
+
+def _counting_activity(blocks, counts):
+    # Passes feature blocks through, adding up their frames and voice-active frames in counts
+    for block in blocks:
+        counts[0] += len(block['voice_activity'])
+        counts[1] += int(np.count_nonzero(block['voice_activity']))
+        yield block
+
+
+def _analyze_streaming(job, ref_bytes, takes, take_durations, library_song):
+    # The reference is streamed once and every take is compared against it block by block in lockstep
+    total_seconds = max(duration or 0.0 for duration in take_durations) or 1.0
+
+    def ref_blocks():
+        # Progress follows the reference through the comparison, up to the end of the longest take
+        blocks = (feature_blocks(library_song['features']) if library_song
+                  else stream_features(io.BytesIO(ref_bytes)))
+        for i, block in enumerate(blocks):
+            job.report("Comparing your recordings block by block",
+                       0.05 + 0.9 * min(1.0, i * STREAM_BLOCK_SECONDS / total_seconds))
+            yield block
+
+    ref_counts = [0, 0]
+    take_counts = [[0, 0] for _ in takes]
+    with span("streaming_analysis"):
+        comparisons = compare_take_streams(
+            _counting_activity(ref_blocks(), ref_counts),
+            [_counting_activity(stream_features(io.BytesIO(take['bytes'])), counts)
+             for take, counts in zip(takes, take_counts)])
+
+    results = [{
+        'comparison': comparison,
+        'feedback': give_feedback(comparison),
+        'frames_skipped': 1.0 - counts[1] / counts[0] if counts[0] else 0.0,
+    } for comparison, counts in zip(comparisons, take_counts)]
+
+    return {
+        'takes': results,
+        'phrases': None,
+        'streamed': True,
+        'ref_frames_skipped': 1.0 - ref_counts[1] / ref_counts[0] if ref_counts[0] else 0.0,
+    }
@@ -1,107 +1,722 @@
+import io
+import os
+import tempfile
+
 import librosa
 import numpy as np
 import scipy
+import scipy.ndimage
+import soundfile
+
+from alignment import dtw_align, warp_features, align_notes, reference_to_user_index
+from instrumentation import span, adopt
+from scoring import score_takes, band_message, feedback_bands, TRAILING_FEEDBACK_METRICS
+
+# Analysis rate: every clip is decoded once, straight to mono at this rate, with soxr. Sung pitch
+# (up to C7, 2093 Hz, and the harmonics PYIN needs) and the spectral features fit well within 8 kHz.
+# Playback uses the original bytes, never the analysis PCM.
+ANALYSIS_SR = 16000
+RESAMPLE_TYPE = 'soxr_hq'
+# Analysis parameters shared by feature extraction and the feature cache key. At ANALYSIS_SR frames
+# are 96 ms long and 24 ms apart, close to the previous 2048/512 at 22050 Hz, and both sizes are
+# FFT-friendly (3 * 2^n).
+PITCH_FMIN = librosa.note_to_hz('C2')
+PITCH_FMAX = librosa.note_to_hz('C7')
+FRAME_LENGTH = 1536
+HOP_LENGTH = 384
+N_MFCC = 13
+# DTW alignment may shift the user take up to this far from the reference timeline. Late starts and
+# rushed phrases stay well within it; a wider band only gives the path room to chase vibrato.
+ALIGNMENT_BAND_SECONDS = 1.5
+ALIGNMENT_BAND_FRAMES = int(round(ALIGNMENT_BAND_SECONDS * ANALYSIS_SR / HOP_LENGTH))
+# Recordings longer than this are compared block by block with bounded memory
+LONG_RECORDING_SECONDS = 600.0
+# Frames per block in streaming mode (about 12 s at the default hop)
+STREAM_BLOCK_FRAMES = 512
+# Note segmentation: contours are median-smoothed over this many frames (~200 ms) before rounding
+# to semitones, which keeps vibrato from splitting a held note; shorter notes are dropped. DTW
+# alignment smooths both contours the same way so it follows timing rather than vibrato.
+NOTE_SMOOTHING_FRAMES = 9
+MIN_NOTE_SECONDS = 0.1
+# Note-level feedback points out notes sung more than this many cents off, or starting this many
+# seconds away from the take's usual lag, naming at most NOTE_FEEDBACK_LIMIT notes per message
+NOTE_CENTS_TOLERANCE = 50.0
+NOTE_TIMING_TOLERANCE = 0.25
+NOTE_FEEDBACK_LIMIT = 3
+# Bump whenever extract_features changes what it returns so cached features are recomputed
+FEATURES_VERSION = 6
+# Bump whenever segment_notes changes its output so library songs are ingested again
+NOTES_VERSION = 2
+
+# Pitch tracker used when a call does not pick one ('pyin', 'pyin_narrow' or 'yin')
+DEFAULT_PITCH_ENGINE = os.environ.get('MELODY_MENTOR_PITCH_ENGINE', 'pyin')
+# Level of a clip: the LEVEL_PERCENTILE of its frame RMS in dBFS, roughly how loud the singing is.
+# Silence gates sit a fixed distance below it, so a quiet phone recording is gated like a loud one,
+# but never below SILENCE_FLOOR_DB. The level is measured once per clip and handed to every chunk
+# and region, so chunked and whole-clip analysis agree.
+LEVEL_PERCENTILE = 95
+SILENCE_FLOOR_DB = -80.0
+# Frames more than this many dB below the clip level count as unvoiced for plain YIN
+YIN_SILENCE_DB = -35.0
 
-def load_audio(audio_path):
-    # Loads and resamples the audio file.
+# Voice-activity pre-pass: the pitch tracker only runs over regions around frames less than
+# VAD_SILENCE_DB below the clip level (see clip_level) whose zero-crossing rate is below VAD_MAX_ZCR
+# (hiss and breath noise cross zero far more often than sung vowels). The gate is relative so a quiet
+# recording isn't skipped whole. Regions are widened by VAD_PADDING_SECONDS to keep note onsets and
+# give PYIN's Viterbi pass context, and gaps shorter than VAD_MIN_GAP_SECONDS are bridged so a phrase
+# is tracked in one piece. Frames outside every region are unvoiced. Set MELODY_MENTOR_VOICE_ACTIVITY=0
+# to track pitch over every frame.
+VOICE_ACTIVITY = os.environ.get('MELODY_MENTOR_VOICE_ACTIVITY', '1') != '0'
+VAD_SILENCE_DB = -40.0
+VAD_MAX_ZCR = 0.3
+VAD_PADDING_SECONDS = 0.25
+VAD_MIN_GAP_SECONDS = 0.5
+
+# Long clips are split into chunks of this length (plus overlap on both sides) for parallel extraction
+ANALYSIS_CHUNK_SECONDS = 30.0
+CHUNK_OVERLAP_SECONDS = 1.0
+# Chunked results match the serial path within these tolerances: RMS and centroid frames are
+# identical up to float rounding (relative 1e-5), and at least 99% of voiced pitch frames agree
+# within 1 cent (PYIN's Viterbi path can differ for a few frames next to a chunk boundary).
+PARALLEL_TOLERANCE_RTOL = 1e-5
+PARALLEL_TOLERANCE_CENTS = 1.0
+PARALLEL_TOLERANCE_PITCH_FRACTION = 0.99
+
+def _decode(source, sr):
+    # Decodes a path or file-like object; in-memory data that soundfile can't read (e.g. mp3 with an
+    # old libsndfile) goes through a uniquely named temporary file for audioread instead.
     try:
-        audio, sr = librosa.load(audio_path)
-        return audio, sr
+        return librosa.load(source, sr=sr, mono=True, res_type=RESAMPLE_TYPE)
+    except Exception:
+        if not isinstance(source, io.IOBase):
+            raise
+        source.seek(0)
+        with tempfile.NamedTemporaryFile(suffix='.audio') as tmp:
+            tmp.write(source.read())
+            tmp.flush()
+            return librosa.load(tmp.name, sr=sr, mono=True, res_type=RESAMPLE_TYPE)
+
+def load_audio(audio_source, sr=ANALYSIS_SR):
+    # Decodes an audio file path, raw bytes or a file-like buffer to mono float32 PCM at sr, in one pass.
+    try:
+        if isinstance(audio_source, (bytes, bytearray, memoryview)):
+            audio_source = io.BytesIO(audio_source)
+        audio, sr = _decode(audio_source, sr)
+        return np.asarray(audio, dtype=np.float32), sr
     except Exception as e:
         print(f"Error loading audio file: {e}")
         return None, None
 
-def extract_features(audio, sr):
-    # Extracts audio features relevant to singing quality.
-    features = {}
-    
-    # Extract pitch using PYIN (more reliable for singing voice)
-    f0, voiced_flag, voiced_probs = librosa.pyin(audio, 
-                                               fmin=librosa.note_to_hz('C2'), 
-                                               fmax=librosa.note_to_hz('C7'),
-                                               sr=sr)
+def frame_params(sr):
+    # Frame and hop lengths for a sample rate, keeping the frame durations used at ANALYSIS_SR.
+    scale = sr / ANALYSIS_SR
+    return int(round(FRAME_LENGTH * scale)), int(round(HOP_LENGTH * scale))
+
+def analysis_params(sr, fmin=PITCH_FMIN, fmax=PITCH_FMAX, hop_length=HOP_LENGTH, engine=None):
+    # Parameters that determine the extracted features, used to key cached results.
+    return {
+        'sr': int(sr),
+        'fmin': float(fmin),
+        'fmax': float(fmax),
+        'frame_length': FRAME_LENGTH,
+        'hop_length': int(hop_length),
+        'pitch_engine': engine or DEFAULT_PITCH_ENGINE,
+        'voice_activity': VOICE_ACTIVITY,
+        'features_version': FEATURES_VERSION,
+        'librosa_version': librosa.__version__,
+    }
+
+def vocal_range(pitch, margin_semitones=3):
+    # Estimates the (fmin, fmax) a pitch track actually uses, widened by a safety margin.
+    voiced_pitch = pitch[pitch > 0]
+    if len(voiced_pitch) == 0:
+        return None
+
+    # Percentiles rather than min/max so octave errors and glitches don't widen the range
+    low, high = np.percentile(voiced_pitch, [2, 98])
+    margin = 2 ** (margin_semitones / 12)
+    fmin = max(low / margin, PITCH_FMIN)
+    fmax = min(high * margin, PITCH_FMAX)
+    return fmin, fmax
+
+def clip_level(audio, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH, center=True):
+    # Level of a clip in dBFS (see LEVEL_PERCENTILE); SILENCE_FLOOR_DB for an empty or silent clip.
+    rms = librosa.feature.rms(y=audio, frame_length=frame_length, hop_length=hop_length, center=center)[0]
+    if len(rms) == 0:
+        return SILENCE_FLOOR_DB
+    return max(float(librosa.amplitude_to_db(np.percentile(rms, LEVEL_PERCENTILE), ref=1.0)), SILENCE_FLOOR_DB)
+
+def silence_gate(level_db, relative_db):
+    # Absolute gate in dBFS: relative_db below the clip level, but not below SILENCE_FLOOR_DB.
+    return max(level_db + relative_db, SILENCE_FLOOR_DB)
+
+def _pitch_pyin(audio, sr, fmin, fmax, frame_length, hop_length, center, pitch_range=None, level_db=None):
+    # Full-range PYIN: slowest engine, used as the accuracy baseline.
+    f0, voiced_flag, voiced_probs = librosa.pyin(audio,
+                                               fmin=fmin,
+                                               fmax=fmax,
+                                               sr=sr,
+                                               frame_length=frame_length,
+                                               hop_length=hop_length,
+                                               center=center)
     # Replace NaN values with zeros
-    f0 = np.nan_to_num(f0)
+    return np.nan_to_num(f0), voiced_flag
+
+def _pitch_yin(audio, sr, fmin, fmax, frame_length, hop_length, center, pitch_range=None, level_db=None):
+    # Plain YIN: vectorized and fast, but has no voicing decision of its own. level_db is the level of
+    # the whole clip when this is one chunk or region of it; by default it is measured here.
+    f0 = librosa.yin(audio, fmin=fmin, fmax=fmax, sr=sr,
+                     frame_length=frame_length, hop_length=hop_length, center=center)
+
+    # Treat quiet frames as unvoiced so silence doesn't produce spurious pitch
+    rms = librosa.feature.rms(y=audio, frame_length=frame_length, hop_length=hop_length, center=center)[0]
+    if level_db is None:
+        level_db = clip_level(audio, frame_length, hop_length, center)
+    voiced_flag = librosa.amplitude_to_db(rms, ref=1.0) > silence_gate(level_db, YIN_SILENCE_DB)
+    return np.where(voiced_flag, f0, 0.0), voiced_flag
+
+def _pitch_pyin_narrow(audio, sr, fmin, fmax, frame_length, hop_length, center, pitch_range=None, level_db=None):
+    # PYIN restricted to the singer's range; fewer pitch states makes the Viterbi pass much cheaper.
+    if pitch_range is None:
+        # No reference range supplied: estimate it from a quick YIN pass over this clip
+        rough_pitch, _ = _pitch_yin(audio, sr, fmin, fmax, frame_length, hop_length, center, level_db=level_db)
+        pitch_range = vocal_range(rough_pitch)
+    if pitch_range is not None:
+        fmin, fmax = pitch_range
+    return _pitch_pyin(audio, sr, fmin, fmax, frame_length, hop_length, center)
+
+PITCH_ENGINES = {
+    'pyin': _pitch_pyin,
+    'pyin_narrow': _pitch_pyin_narrow,
+    'yin': _pitch_yin,
+}
+
+def voice_activity(audio, sr, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH, center=True, level_db=None):
+    # Marks the frames worth running the pitch tracker on, from RMS energy and zero-crossing rate.
+    # Returns one boolean per frame on the same grid as estimate_pitch. Both measures are per frame and
+    # the energy gate follows level_db, the whole clip's level (measured from audio when omitted), so
+    # chunked and whole-clip analysis pick the same frames away from chunk edges.
+    rms = librosa.feature.rms(y=audio, frame_length=frame_length, hop_length=hop_length, center=center)[0]
+    zcr = librosa.feature.zero_crossing_rate(audio, frame_length=frame_length, hop_length=hop_length,
+                                             center=center)[0]
+    if level_db is None:
+        level_db = clip_level(audio, frame_length, hop_length, center)
+    loud = librosa.amplitude_to_db(rms, ref=1.0) > silence_gate(level_db, VAD_SILENCE_DB)
+    active = loud & (zcr < VAD_MAX_ZCR)
+
+    padding = int(round(VAD_PADDING_SECONDS * sr / hop_length))
+    if padding and np.any(active):
+        active = scipy.ndimage.binary_dilation(active, structure=np.ones(2 * padding + 1, dtype=bool))
+
+    # Bridge the short inactive runs between two active ones
+    min_gap = int(round(VAD_MIN_GAP_SECONDS * sr / hop_length))
+    starts, stops = voice_regions(active)
+    for gap_start, gap_stop in zip(stops[:-1], starts[1:]):
+        if gap_stop - gap_start < min_gap:
+            active[gap_start:gap_stop] = True
+    return active
+
+def voice_regions(active):
+    # (starts, stops) arrays of the runs of active frames, stops exclusive.
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], np.asarray(active, dtype=np.int8), [0]))))
+    return edges[::2], edges[1::2]
+
+def _pitch_in_regions(track, audio, sr, fmin, fmax, frame_length, hop_length, center, pitch_range, active,
+                      level_db=None):
+    # Runs a pitch engine over each active region only and places the results on the full frame grid.
+    # Regions start on a hop boundary and keep half a frame of real audio either side (as plan_chunks
+    # does for chunks), so their frames line up with, and match, the frames of a whole-clip pass.
+    f0 = np.zeros(len(active))
+    voiced_flag = np.zeros(len(active), dtype=bool)
+    context = int(np.ceil(frame_length / 2 / hop_length)) if center else 0
+    for start, stop in zip(*voice_regions(active)):
+        first = max(start - context, 0)
+        end = (stop + context) * hop_length if center else (stop - 1) * hop_length + frame_length
+        region_f0, region_voiced = track(audio[first * hop_length:min(end, len(audio))], sr, fmin, fmax,
+                                         frame_length, hop_length, center, pitch_range=pitch_range,
+                                         level_db=level_db)
+        kept = slice(start - first, stop - first)
+        f0[start:stop] = region_f0[kept]
+        voiced_flag[start:stop] = region_voiced[kept]
+    return f0, voiced_flag
+
+def estimate_pitch(audio, sr, engine=None, fmin=PITCH_FMIN, fmax=PITCH_FMAX, frame_length=FRAME_LENGTH,
+                   hop_length=HOP_LENGTH, center=True, pitch_range=None, active=None, level_db=None):
+    # Runs the selected pitch engine and returns (f0 with zeros for unvoiced frames, voiced flags).
+    # With active (from voice_activity) only the active regions are tracked; other frames are unvoiced.
+    # level_db is the clip level (see clip_level) the silence gates are set from; measured when omitted.
+    engine = engine or DEFAULT_PITCH_ENGINE
+    if engine not in PITCH_ENGINES:
+        raise ValueError(f"Unknown pitch engine '{engine}'. Choose one of: {', '.join(PITCH_ENGINES)}")
+    if active is None:
+        return PITCH_ENGINES[engine](audio, sr, fmin, fmax, frame_length, hop_length, center,
+                                     pitch_range=pitch_range, level_db=level_db)
+    if engine == 'pyin_narrow' and pitch_range is None:
+        # Fix the narrowed range from the whole clip so every region searches the same range
+        pitch_range = reference_pitch_range(audio, sr, engine=engine)
+    if level_db is None:
+        # Regions are gated against the whole clip's level, not their own
+        level_db = clip_level(audio, frame_length, hop_length, center)
+    return _pitch_in_regions(PITCH_ENGINES[engine], audio, sr, fmin, fmax, frame_length, hop_length, center,
+                             pitch_range, active, level_db)
+
+def spectral_features(audio, sr, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH, center=True, n_mfcc=N_MFCC):
+    # Derives every spectral feature from one magnitude STFT so the clip is framed and FFT'd once.
+    S = np.abs(librosa.stft(audio, n_fft=frame_length, hop_length=hop_length, center=center))
+    features = {}
+
+    # RMS energy (volume). librosa measures RMS of the Hann-windowed frame when given a spectrogram,
+    # so undo the window's average power to stay close to the time-domain RMS scale.
+    window_power = np.mean(scipy.signal.get_window('hann', frame_length) ** 2)
+    features['rms'] = librosa.feature.rms(S=S, frame_length=frame_length)[0] / np.sqrt(window_power)
+
+    # Spectral centroid (brightness/timbre)
+    features['spectral_centroid'] = librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=frame_length)[0]
+
+    # Rolloff and flatness (breathiness / noisiness)
+    features['spectral_rolloff'] = librosa.feature.spectral_rolloff(S=S, sr=sr, n_fft=frame_length)[0]
+    features['spectral_flatness'] = librosa.feature.spectral_flatness(S=S)[0]
+
+    # MFCCs (timbre), via a mel spectrogram of the same STFT
+    mel = librosa.feature.melspectrogram(S=S ** 2, sr=sr, n_fft=frame_length)
+    features['mfcc'] = librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=n_mfcc)
+
+    return features
+
+def extract_features(audio, sr, fmin=PITCH_FMIN, fmax=PITCH_FMAX, frame_length=FRAME_LENGTH,
+                     hop_length=HOP_LENGTH, center=True, engine=None, pitch_range=None, level_db=None):
+    # Extracts audio features relevant to singing quality. level_db is the level of the whole clip
+    # when audio is one chunk of it (see clip_level); otherwise it is measured from audio.
+    # Every feature shares one frame grid: frame i is centred on sample i * hop_length
+    # (or starts there when center=False, as for pre-framed stream blocks).
+    features = {}
+    if level_db is None:
+        level_db = clip_level(audio, frame_length, hop_length, center)
+
+    # Cheap pre-pass finding where someone may be singing; 'voice_activity' records which frames the
+    # pitch tracker ran on (all of them when the pre-pass is off)
+    with span('voice_activity'):
+        active = voice_activity(audio, sr, frame_length=frame_length, hop_length=hop_length,
+                                center=center, level_db=level_db) if VOICE_ACTIVITY else None
+
+    # Extract pitch with the configured engine (PYIN by default, more reliable for singing voice)
+    with span('pitch'):
+        f0, voiced_flag = estimate_pitch(audio, sr, engine=engine, fmin=fmin, fmax=fmax, frame_length=frame_length,
+                                         hop_length=hop_length, center=center, pitch_range=pitch_range,
+                                         active=active, level_db=level_db)
     features['pitch'] = f0
+    features['voiced_flag'] = voiced_flag
+    features['voice_activity'] = active if active is not None else np.ones(len(f0), dtype=bool)
     
-    # RMS energy (volume)
-    features['rms'] = librosa.feature.rms(y=audio)[0]
-    
-    # Spectral centroid (brightness/timbre)
-    features['spectral_centroid'] = librosa.feature.spectral_centroid(y=audio, sr=sr)[0]
+    # Volume and timbre features from a single shared STFT
+    with span('spectral_features'):
+        features.update(spectral_features(audio, sr, frame_length=frame_length, hop_length=hop_length,
+                                          center=center))
     
     return features
 
-def compare_features(ref_features, user_features):
+def skipped_fraction(features):
+    # Fraction of frames the voice-activity pre-pass kept away from the pitch tracker.
+    active = features.get('voice_activity')
+    if active is None or len(active) == 0:
+        return 0.0
+    return 1.0 - float(np.count_nonzero(active)) / len(active)
+
+def reference_pitch_range(ref_audio, sr, ref_features=None, engine=None):
+    # Vocal range of the reference used to narrow the user's pitch search (only pyin_narrow uses it).
+    if (engine or DEFAULT_PITCH_ENGINE) != 'pyin_narrow':
+        return None
+    if ref_features is not None:
+        return vocal_range(ref_features['pitch'])
+    rough_pitch, _ = _pitch_yin(ref_audio, sr, PITCH_FMIN, PITCH_FMAX, FRAME_LENGTH, HOP_LENGTH, True)
+    return vocal_range(rough_pitch)
+
+def plan_chunks(n_samples, sr, hop_length=HOP_LENGTH, chunk_seconds=ANALYSIS_CHUNK_SECONDS,
+                overlap_seconds=CHUNK_OVERLAP_SECONDS):
+    # Splits a clip into overlapping, hop-aligned chunks.
+    # Returns (start_sample, end_sample, first_kept_frame, last_kept_frame) per chunk, with kept
+    # frames counted within the chunk, so the kept frames of all chunks tile the full frame grid.
+    n_frames = 1 + n_samples // hop_length
+    core_frames = max(1, int(round(chunk_seconds * sr / hop_length)))
+    margin_frames = int(np.ceil(overlap_seconds * sr / hop_length))
+
+    chunks = []
+    for first_frame in range(0, n_frames, core_frames):
+        last_frame = min(first_frame + core_frames, n_frames)
+        padded_first = max(first_frame - margin_frames, 0)
+        start = padded_first * hop_length
+        end = min((last_frame + margin_frames) * hop_length, n_samples)
+        chunks.append((start, end, first_frame - padded_first, last_frame - padded_first))
+    return chunks
+
+def _extract_chunk(audio, sr, keep_start, keep_stop, kwargs):
+    # Worker entry point: extracts features for one chunk and drops its overlap frames.
+    # The chunk's spans are returned alongside so the parent process can report them.
+    with span('extract_chunk') as chunk_span:
+        features = extract_features(audio, sr, **kwargs)
+    return {name: value[..., keep_start:keep_stop] for name, value in features.items()}, chunk_span.to_dict()
+
+def submit_features(executor, audio, sr, chunk_seconds=ANALYSIS_CHUNK_SECONDS,
+                    overlap_seconds=CHUNK_OVERLAP_SECONDS, **kwargs):
+    # Schedules chunked feature extraction on an executor; pass the result to collect_features().
+    if kwargs.get('engine', DEFAULT_PITCH_ENGINE) == 'pyin_narrow' and kwargs.get('pitch_range') is None:
+        # Fix the narrowed range once for the whole clip so every chunk searches the same range
+        kwargs['pitch_range'] = reference_pitch_range(audio, sr, engine='pyin_narrow')
+    if kwargs.get('level_db') is None:
+        # Likewise the level the silence gates are set from
+        kwargs['level_db'] = clip_level(audio, kwargs.get('frame_length', FRAME_LENGTH),
+                                        kwargs.get('hop_length', HOP_LENGTH))
+
+    hop_length = kwargs.get('hop_length', HOP_LENGTH)
+    return [
+        executor.submit(_extract_chunk, audio[start:end], sr, keep_start, keep_stop, kwargs)
+        for start, end, keep_start, keep_stop in plan_chunks(len(audio), sr, hop_length,
+                                                              chunk_seconds, overlap_seconds)
+    ]
+
+def collect_features(pending):
+    # Waits for the chunks scheduled by submit_features() and stitches them into one feature set.
+    results = [future.result() for future in pending]
+    adopt([chunk_span for _, chunk_span in results])
+    chunks = [features for features, _ in results]
+    return {name: np.concatenate([chunk[name] for chunk in chunks], axis=-1) for name in chunks[0]}
+
+def segment_notes(pitch, sr, hop_length=HOP_LENGTH, min_note_seconds=MIN_NOTE_SECONDS):
+    # Segments a pitch contour into notes with vectorized run-length operations on the voiced mask.
+    # Returns a dict of equal-length arrays: onset/offset (s), pitch (median Hz), midi and stability
+    # (standard deviation within the note, in cents).
+    pitch = np.asarray(pitch, dtype=np.float64)
+    voiced = pitch > 0
+    midi = np.zeros(len(pitch))
+    midi[voiced] = librosa.hz_to_midi(pitch[voiced])
+
+    # Label each frame with its nearest semitone (0 when unvoiced) after smoothing out vibrato. Semitones
+    # are counted from the contour's own tuning, so a singer who is steadily sharp or flat doesn't sit on
+    # the rounding boundary and have held notes split in two.
+    smoothed = scipy.ndimage.median_filter(midi, size=NOTE_SMOOTHING_FRAMES, mode='nearest')
+    tuning = librosa.pitch_tuning(pitch[voiced]) if np.count_nonzero(voiced) > 1 else 0.0
+    labels = np.where(voiced & (smoothed > 0), np.round(smoothed - tuning), 0)
+
+    # Runs of constant label: a new run starts wherever the label changes
+    change = np.diff(labels, prepend=-1) != 0
+    run_of_frame = np.cumsum(change) - 1
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], len(labels))
+    min_frames = max(1, int(round(min_note_seconds * sr / hop_length)))
+    keep = (labels[starts] > 0) & (ends - starts >= min_frames)
+
+    # Map every frame to its note index (-1 for unvoiced runs and notes that are too short)
+    note_of_run = np.full(len(starts), -1)
+    note_of_run[keep] = np.arange(np.count_nonzero(keep))
+    note_of_frame = note_of_run[run_of_frame]
+    starts, ends = starts[keep], ends[keep]
+
+    notes = {
+        'onset': starts * hop_length / sr,
+        'offset': ends * hop_length / sr,
+        'pitch': np.zeros(len(starts)),
+        'midi': np.zeros(len(starts)),
+        'stability': np.zeros(len(starts)),
+    }
+    if len(starts) == 0:
+        return notes
+
+    # Voiced frames of every note, tagged with the note they belong to
+    in_note = (note_of_frame >= 0) & voiced
+    note_ids, values = note_of_frame[in_note], midi[in_note]
+
+    # Median per note: sort by (note, value) and take the middle element(s) of each group
+    order = np.lexsort((values, note_ids))
+    sorted_values = values[order]
+    counts = np.bincount(note_ids, minlength=len(starts))
+    offsets = np.cumsum(counts) - counts
+    median_midi = (sorted_values[offsets + (counts - 1) // 2] + sorted_values[offsets + counts // 2]) / 2
+
+    # Stability: standard deviation within each note, from per-note sums
+    mean_midi = np.bincount(note_ids, weights=values, minlength=len(starts)) / counts
+    mean_square = np.bincount(note_ids, weights=values ** 2, minlength=len(starts)) / counts
+    notes['midi'] = median_midi
+    notes['pitch'] = librosa.midi_to_hz(median_midi)
+    notes['stability'] = 100 * np.sqrt(np.maximum(mean_square - mean_midi ** 2, 0))
+    return notes
+
+class FeatureAccumulator:
+    # Running sums behind compare_features. Blocks of frame-aligned reference/user features can be fed
+    # one at a time, so a comparison needs memory for one block rather than the whole recording.
+    def __init__(self):
+        self.cents_sum = 0.0
+        self.voiced_frames = 0
+        self.rms_sum = 0.0
+        self.centroid_sum = 0.0
+        self.frames = 0
+
+    def update(self, ref_block, user_block):
+        # Adds one block of frames; the shorter side decides how many frames are compared.
+        length = min(len(ref_block['pitch']), len(user_block['pitch']))
+        ref_pitch = ref_block['pitch'][:length]
+        user_pitch = user_block['pitch'][:length]
+
+        # Filter out zeros (unvoiced segments)
+        voiced_indices = (ref_pitch > 0) & (user_pitch > 0)
+        if np.any(voiced_indices):
+            # Convert Hz difference to cents (musical perception)
+            cents_diff = 1200 * np.log2(user_pitch[voiced_indices] / ref_pitch[voiced_indices])
+            self.cents_sum += float(np.sum(np.abs(cents_diff)))
+            self.voiced_frames += int(np.count_nonzero(voiced_indices))
+
+        self.rms_sum += float(np.sum(np.abs(ref_block['rms'][:length] - user_block['rms'][:length])))
+        self.centroid_sum += float(np.sum(np.abs(
+            ref_block['spectral_centroid'][:length] - user_block['spectral_centroid'][:length]
+        )))
+        self.frames += length
+
+    def result(self):
+        # Mean absolute deviations over every frame seen so far.
+        frames = self.frames if self.frames else np.nan
+        return {
+            'pitch_deviation': self.cents_sum / self.voiced_frames if self.voiced_frames else None,
+            'rms_deviation': self.rms_sum / frames,
+            'spectral_centroid_deviation': self.centroid_sum / frames,
+        }
+
+def compare_notes(ref_notes, user_notes, expected_onsets=None):
+    # Compares two note sequences from segment_notes() after aligning them note by note.
+    # Notes are paired by pitch and by timing: expected_onsets are where each reference note should
+    # start in the take (by default where it starts in the reference). A first pass finds the take's
+    # overall detune; the second pairs notes with it removed, so a take sung steadily sharp shows a
+    # steady detune rather than mismatched notes.
+    # Per-note arrays follow the reference notes: note_cents is the user's pitch minus the reference's
+    # and note_onset_error the onset difference minus the take's median lag (so a late start isn't
+    # counted against every note); both are NaN for notes the user missed or never reached.
+    ref_midi = np.asarray(ref_notes['midi'], dtype=np.float64)
+    user_midi = np.asarray(user_notes['midi'], dtype=np.float64)
+    if expected_onsets is None:
+        expected_onsets = ref_notes['onset']
+    pairs = align_notes(ref_midi, user_midi, expected_onsets, user_notes['onset'])
+    matched = pairs[(pairs[:, 0] >= 0) & (pairs[:, 1] >= 0)]
+    offset = float(np.median(user_midi[matched[:, 1]] - ref_midi[matched[:, 0]])) if len(matched) else 0.0
+    if offset:
+        pairs = align_notes(ref_midi, user_midi - offset, expected_onsets, user_notes['onset'])
+        matched = pairs[(pairs[:, 0] >= 0) & (pairs[:, 1] >= 0)]
+    ref_index, user_index = matched[:, 0], matched[:, 1]
+    n_ref = len(ref_midi)
+    # Notes past the end of the alignment were not sung at all (a partial take) and aren't scored
+    compared_ref = int(np.count_nonzero(pairs[:, 0] >= 0))
+    compared_user = int(np.count_nonzero(pairs[:, 1] >= 0))
+
+    cents = np.full(n_ref, np.nan)
+    onset_error = np.full(n_ref, np.nan)
+    if len(matched):
+        cents[ref_index] = 100 * (user_midi[user_index] - ref_midi[ref_index])
+        lag = np.asarray(user_notes['onset'])[user_index] - np.asarray(ref_notes['onset'])[ref_index]
+        onset_error[ref_index] = lag - np.median(lag)
+
+    return {
+        'note_pitch_deviation': float(np.mean(np.abs(cents[ref_index]))) if len(matched) else None,
+        'notes_matched': len(matched),
+        'notes_missed': compared_ref - len(matched),
+        'notes_extra': compared_user - len(matched),
+        # Median detune of the matched notes, in cents
+        'key_offset_cents': 100 * offset,
+        'note_onset': np.asarray(ref_notes['onset']),
+        'note_midi': np.asarray(ref_notes['midi']),
+        'note_cents': cents,
+        'note_onset_error': onset_error,
+    }
+
+def compare_takes(ref_features, takes, align=True, band_frames=ALIGNMENT_BAND_FRAMES, sr=ANALYSIS_SR,
+                  ref_notes=None, hop_length=HOP_LENGTH):
+    # Compares any number of takes with one reference; returns one comparison per take.
+    # Each take is DTW-warped onto the reference timeline and note-compared on its own, then every
+    # take is scored at once by the scoring engine. sr and hop_length define the frame grid; pass
+    # ref_notes when the reference's notes are precomputed.
+    if ref_notes is None:
+        ref_notes = segment_notes(ref_features['pitch'], sr, hop_length)
+
+    comparisons, warped = [], []
+    n_ref = len(ref_features['pitch'])
+    for user_features in takes:
+        comparison = {}
+        path = np.zeros((0, 2), dtype=int)
+        if align:
+            # Warp the take onto the reference timeline so a late or rushed start isn't scored as off-pitch
+            path = dtw_align(ref_features['pitch'], user_features['pitch'], band_radius=band_frames,
+                             smoothing_frames=NOTE_SMOOTHING_FRAMES)
+
+        # Note-level comparison on the unwarped contours, each reference note expected where the
+        # warping path puts it in the take
+        expected_onsets = None
+        if len(path):
+            user_index = reference_to_user_index(path, n_ref)
+            onset_frames = np.round(np.asarray(ref_notes['onset']) * sr / hop_length).astype(int)
+            expected_onsets = user_index[np.clip(onset_frames, 0, len(user_index) - 1)] * hop_length / sr
+        comparison['notes'] = compare_notes(ref_notes, segment_notes(user_features['pitch'], sr, hop_length),
+                                            expected_onsets)
+
+        if len(path):
+            user_features = warp_features(user_features, path, n_ref)
+            comparison['alignment_path'] = path
+        comparisons.append(comparison)
+        warped.append(user_features)
+
+    # Pitch, vibrato, dynamics and timbre metrics for all takes in one vectorized pass
+    scores = score_takes(ref_features, warped, sr, hop_length,
+                         note_comparisons=[comparison['notes'] for comparison in comparisons], unwarped=takes)
+    for comparison, take_scores in zip(comparisons, scores):
+        comparison.update(take_scores)
+    return comparisons
+
+def compare_features(ref_features, user_features, align=True, band_frames=ALIGNMENT_BAND_FRAMES, sr=ANALYSIS_SR,
+                     ref_notes=None, hop_length=HOP_LENGTH):
     # Compares the features of the reference and user audio.
-    comparison = {}
-    
-    # Ensure consistent length for comparison
-    min_length = min(len(ref_features['pitch']), len(user_features['pitch']))
-    
-    # Compare pitch
-    ref_pitch = ref_features['pitch'][:min_length]
-    user_pitch = user_features['pitch'][:min_length]
-    
-    # Filter out zeros (unvoiced segments)
-    voiced_indices = (ref_pitch > 0) & (user_pitch > 0)
-    
-    if np.any(voiced_indices):
-        # Calculate pitch deviation in cents (musical unit) for better feedback
-        ref_pitch_voiced = ref_pitch[voiced_indices]
-        user_pitch_voiced = user_pitch[voiced_indices]
-        
-        # Convert Hz difference to cents (musical perception)
-        cents_diff = 1200 * np.log2(user_pitch_voiced / ref_pitch_voiced)
-        comparison['pitch_deviation'] = np.mean(np.abs(cents_diff))
-    else:
-        comparison['pitch_deviation'] = None
-    
-    # Compare RMS energy (volume)
-    min_rms_length = min(len(ref_features['rms']), len(user_features['rms']))
-    comparison['rms_deviation'] = np.mean(np.abs(
-        ref_features['rms'][:min_rms_length] - user_features['rms'][:min_rms_length]
-    ))
-    
-    # Compare spectral centroid (timbre)
-    min_spec_length = min(len(ref_features['spectral_centroid']), len(user_features['spectral_centroid']))
-    comparison['spectral_centroid_deviation'] = np.mean(np.abs(
-        ref_features['spectral_centroid'][:min_spec_length] - user_features['spectral_centroid'][:min_spec_length]
-    ))
-    
-    return comparison
+    return compare_takes(ref_features, [user_features], align=align, band_frames=band_frames, sr=sr,
+                         ref_notes=ref_notes, hop_length=hop_length)[0]
+
+def stream_features(audio_source, block_frames=STREAM_BLOCK_FRAMES, engine=None, pitch_range=None):
+    # Yields features block by block for a path or file-like object, decoding at its native sample rate.
+    # Frame and hop lengths are scaled with the sample rate so every stream shares the same time grid
+    # as extract_features, whatever rate the recording uses. Peak memory depends on block_frames only.
+    sr = librosa.get_samplerate(audio_source)
+    if isinstance(audio_source, io.IOBase):
+        audio_source.seek(0)
+    frame_length, hop_length = frame_params(sr)
+
+    blocks = librosa.stream(audio_source, block_length=block_frames, frame_length=frame_length,
+                            hop_length=hop_length, mono=True, fill_value=0)
+    # The whole recording's level isn't known up front, so the silence gates follow the loudest block so
+    # far. A block is never gated against a level below its own.
+    level_db = SILENCE_FLOOR_DB
+    for block in blocks:
+        level_db = max(level_db, clip_level(block, frame_length, hop_length, center=False))
+        # Blocks are pre-framed, so analyse them without centre padding
+        yield extract_features(block, sr, frame_length=frame_length, hop_length=hop_length, center=False,
+                               engine=engine, pitch_range=pitch_range, level_db=level_db)
+
+def feature_blocks(features, block_frames=STREAM_BLOCK_FRAMES):
+    # Yields precomputed (e.g. memory-mapped) features in blocks, in the same shape as stream_features.
+    n_frames = len(features['pitch'])
+    for start in range(0, n_frames, block_frames):
+        yield {name: np.asarray(value[..., start:start + block_frames]) for name, value in features.items()}
+
+def compare_feature_streams(ref_blocks, user_blocks, sr=ANALYSIS_SR):
+    # Compares two feature streams with running accumulators; stops when either recording ends.
+    # Streams are compared frame by frame without DTW alignment, which needs both tracks in memory.
+    # Only the pitch contours (a few bytes per frame) are kept, for the note-level comparison.
+    return compare_take_streams(ref_blocks, [user_blocks], sr)[0]
+
+def compare_take_streams(ref_blocks, take_blocks, sr=ANALYSIS_SR):
+    # Compares several takes' feature streams against one pass over the reference stream, so the
+    # reference is decoded and analysed once however many takes there are. Each reference block is
+    # paired with the next block of every take that hasn't ended; a take stops being compared when it
+    # ends, and the reference is read only as long as some take is still running.
+    # Returns one comparison per take, as compare_feature_streams does for a single one.
+    take_blocks = [iter(blocks) for blocks in take_blocks]
+    accumulators = [FeatureAccumulator() for _ in take_blocks]
+    running = [True] * len(take_blocks)
+    ref_pitch = []
+    user_pitch = [[] for _ in take_blocks]
+    ref_frames = [0] * len(take_blocks)
+    for ref_block in ref_blocks:
+        if not any(running):
+            break
+        ref_pitch.append(np.asarray(ref_block['pitch']))
+        for k, blocks in enumerate(take_blocks):
+            user_block = next(blocks, None) if running[k] else None
+            if user_block is None:
+                running[k] = False
+                continue
+            accumulators[k].update(ref_block, user_block)
+            length = min(len(ref_block['pitch']), len(user_block['pitch']))
+            user_pitch[k].append(np.asarray(user_block['pitch'][:length]))
+            ref_frames[k] += length
+
+    comparisons = []
+    ref_contour = np.concatenate(ref_pitch) if ref_pitch else np.zeros(0)
+    for accumulator, pitch, frames in zip(accumulators, user_pitch, ref_frames):
+        comparison = accumulator.result()
+        if pitch:
+            # Blocks line up frame for frame, so a take's frames are the first ones of the reference
+            comparison['notes'] = compare_notes(segment_notes(ref_contour[:frames], sr),
+                                                segment_notes(np.concatenate(pitch), sr))
+        comparisons.append(comparison)
+    return comparisons
+
+@span("warm_up")
+def warm_up(sr=ANALYSIS_SR, seconds=1.0):
+    # Runs the analysis once on a short tone. librosa imports its submodules (and scipy.signal) on
+    # first use and compiles its numba kernels on first call, which costs the first real analysis
+    # in a process several seconds.
+    t = np.arange(int(sr * seconds)) / sr
+    audio = (0.3 * np.sin(2 * np.pi * 220.0 * t)).astype(np.float32)
+    features = extract_features(audio, sr)
+    notes = segment_notes(features['pitch'], sr)
+    give_feedback(compare_features(features, features, sr=sr, ref_notes=notes))
+
+def audio_duration(audio_source):
+    # Duration in seconds read from the file header, without decoding the audio.
+    if isinstance(audio_source, (bytes, bytearray, memoryview)):
+        audio_source = io.BytesIO(audio_source)
+    try:
+        return soundfile.info(audio_source).duration
+    except Exception:
+        return None
 
-def give_feedback(comparison_results):
-    # Provides feedback to the user based on the comparison.
+def _format_time(seconds):
+    return f"{int(seconds // 60)}:{int(seconds % 60):02d}"
+
+def _note_feedback(notes):
+    # Names the notes that were furthest off pitch, missed notes and notes that came in early or late.
     feedback = []
-    
-    if comparison_results['pitch_deviation'] is not None:
-        # Pitch feedback based on cents difference
-        if comparison_results['pitch_deviation'] < 50:  # Less than 50 cents (half semitone)
-            feedback.append("Your pitch accuracy is excellent! You're staying very close to the original melody.")
-        elif comparison_results['pitch_deviation'] < 100:  # Less than 1 semitone
-            feedback.append("Your pitch is good but could use some fine-tuning. Try focusing on the more challenging note transitions.")
-        elif comparison_results['pitch_deviation'] < 200:  # Less than 2 semitones
-            feedback.append("Your pitch needs some work. Try singing with the reference audio and pay attention to the melody.")
-        else:
-            feedback.append("Your pitch needs significant improvement. Consider practicing with a piano or vocal warm-ups to improve your pitch accuracy.")
-    else:
-        feedback.append("Could not compare pitch. Ensure both audios have clear vocal content.")
-    
-    # Volume feedback
-    if comparison_results['rms_deviation'] < 0.05:
-        feedback.append("Your volume control is excellent!")
-    elif comparison_results['rms_deviation'] < 0.1:
-        feedback.append("Your volume consistency is good. Minor adjustments needed for perfect dynamics.")
-    else:
-        feedback.append("Work on maintaining more consistent volume. Practice breath control for better volume regulation.")
-    
-    # Timbre feedback
-    if comparison_results['spectral_centroid_deviation'] < 200:
-        feedback.append("Your vocal tone/timbre matches the original very well!")
-    elif comparison_results['spectral_centroid_deviation'] < 500:
-        feedback.append("Your vocal tone is fairly close to the original. Focus on vowel shapes to better match the timbre.")
+    cents = notes['note_cents']
+    # A steady detune is one problem, not one per note: name it once and judge notes against it
+    offset = notes.get('key_offset_cents', 0.0)
+    if abs(offset) > NOTE_CENTS_TOLERANCE:
+        feedback.append(f"Your whole take is about {abs(offset):.0f} cents {'sharp' if offset > 0 else 'flat'} "
+                        "of the reference, though the melody itself is right. Play the reference's first note "
+                        "and match it before you start.")
     else:
-        feedback.append("Your vocal timbre differs significantly from the reference. Experiment with different vocal techniques and resonance to match the original sound better.")
-    
-    return feedback
\ No newline at end of file
+        offset = 0.0
+    off_pitch = np.flatnonzero(np.abs(np.nan_to_num(cents - offset)) > NOTE_CENTS_TOLERANCE)
+    if len(off_pitch):
+        worst = off_pitch[np.argsort(-np.abs(cents[off_pitch] - offset))][:NOTE_FEEDBACK_LIMIT]
+        details = [
+            f"{librosa.midi_to_note(notes['note_midi'][i], unicode=False)} at {_format_time(notes['note_onset'][i])} "
+            f"({abs(cents[i]):.0f} cents {'sharp' if cents[i] > 0 else 'flat'})"
+            for i in sorted(worst)
+        ]
+        more = len(off_pitch) - len(worst)
+        feedback.append("Notes to work on: " + ", ".join(details) + (f", and {more} more." if more else "."))
+
+    total = notes['notes_matched'] + notes['notes_missed']
+    if notes['notes_missed'] > 0.1 * total:
+        feedback.append(f"You missed {notes['notes_missed']} of {total} notes in the melody. "
+                        "Listen for the quick passing notes and make sure each one is sung.")
+
+    timing = notes['note_onset_error']
+    off_time = np.flatnonzero(np.abs(np.nan_to_num(timing)) > NOTE_TIMING_TOLERANCE)
+    if len(off_time):
+        examples = ", ".join(
+            f"{_format_time(notes['note_onset'][i])} ({'late' if timing[i] > 0 else 'early'})"
+            for i in off_time[:NOTE_FEEDBACK_LIMIT]
+        )
+        count = f"{len(off_time)} notes" if len(off_time) > 1 else "One note"
+        feedback.append(f"{count} started off the beat, for example at {examples}. "
+                        "Practise those entries slowly with the reference.")
+    return feedback
+
+def give_feedback(comparison_results, bands=None):
+    # Provides feedback to the user based on the comparison, from the scoring engine's feedback bands.
+    # Metrics a comparison doesn't have (streamed comparisons only report the basic three) are skipped.
+    bands = bands or feedback_bands()
+    feedback = [band_message('pitch_deviation', comparison_results.get('pitch_deviation'), bands)]
+
+    # Note-by-note pitch and timing feedback
+    notes = comparison_results.get('notes')
+    if notes is not None and notes['notes_matched']:
+        feedback.extend(_note_feedback(notes))
+
+    # Volume, timbre, dynamics and vibrato
+    for name in TRAILING_FEEDBACK_METRICS:
+        if name in comparison_results:
+            feedback.append(band_message(name, comparison_results[name], bands))
+    return [message for message in feedback if message]
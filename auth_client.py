@@ -0,0 +1,182 @@
+"""HTTP side of authentication: a pooled session for the Firebase Auth REST API and ID token refresh.
+
+Each sign-in used to open a new TCP and TLS connection to identitytoolkit, with no timeout. The
+client here keeps connections alive in a pool shared by every session of the process, bounds every
+request with a timeout and retries requests that never reached the service.
+
+ID tokens expire after an hour. A TokenRefresher thread renews each signed-in session's token shortly
+before it expires, so a rerun only ever reads the current token and never waits on the network.
+Both endpoints can be pointed at auth_stub.py for local load testing.
+"""
+import logging
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("melody_mentor.auth")
+
+DEFAULT_AUTH_URL = "https://identitytoolkit.googleapis.com/v1/accounts"
+DEFAULT_TOKEN_URL = "https://securetoken.googleapis.com/v1/token"
+# Seconds to connect and to wait for a response
+AUTH_TIMEOUT = (3.05, 10.0)
+# Kept-alive connections per host, shared by every session of the process
+POOL_SIZE = 20
+# Sign-up is not idempotent, so only failures where the service cannot have acted are retried:
+# connection errors and rate-limit or unavailable responses
+AUTH_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.3
+RETRY_STATUSES = (429, 503)
+# Tokens are renewed this long before they expire, checked this often
+REFRESH_MARGIN_SECONDS = 300.0
+REFRESH_CHECK_SECONDS = 15.0
+# Wait before retrying a refresh that failed for a transient reason
+REFRESH_RETRY_SECONDS = 30.0
+
+
+def make_session(pool_size=POOL_SIZE, retries=AUTH_RETRIES):
+    """requests.Session with a keep-alive connection pool and retries safe for POST"""
+    retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=RETRY_BACKOFF_SECONDS,
+                  status_forcelist=RETRY_STATUSES, allowed_methods=None, respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AuthClient:
+    """Calls to the accounts and token endpoints over one pooled session"""
+
+    def __init__(self, api_key, auth_url=DEFAULT_AUTH_URL, token_url=DEFAULT_TOKEN_URL, session=None,
+                 timeout=AUTH_TIMEOUT):
+        self.api_key = api_key
+        self.auth_url = auth_url
+        self.token_url = token_url
+        self.session = session or make_session()
+        self.timeout = timeout
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def account(self, action, payload):
+        """POST to an accounts endpoint such as 'signInWithPassword'"""
+        return self.post(f"{self.auth_url}:{action}?key={self.api_key}", json=payload)
+
+    def refresh(self, refresh_token):
+        """Exchange a refresh token for a new ID token; returns the response JSON or raises HTTPError"""
+        response = self.post(f"{self.token_url}?key={self.api_key}",
+                             data={"grant_type": "refresh_token", "refresh_token": refresh_token})
+        response.raise_for_status()
+        return response.json()
+
+
+class TokenState:
+    """A session's current ID token, renewed in the background by a TokenRefresher"""
+
+    def __init__(self, id_token, refresh_token, expires_in, clock=time.time):
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.id_token = id_token
+        self.refresh_token = refresh_token
+        self.expires_at = clock() + float(expires_in)
+        # Earliest time of the next refresh attempt after a transient failure
+        self.retry_at = 0.0
+        # Set when the service rejects the refresh token, e.g. after a password change
+        self.revoked = False
+
+    @classmethod
+    def from_sign_in(cls, user_data, clock=time.time):
+        """Token state from a signInWithPassword response, or None if it carries no refresh token"""
+        if not user_data.get('refreshToken'):
+            return None
+        return cls(user_data.get('idToken'), user_data['refreshToken'], user_data.get('expiresIn', 3600), clock)
+
+    def current(self):
+        """The ID token, or None once it has expired without being renewed"""
+        with self.lock:
+            return self.id_token if self.clock() < self.expires_at else None
+
+    def due(self, margin):
+        with self.lock:
+            now = self.clock()
+            return not self.revoked and now >= self.retry_at and now >= self.expires_at - margin
+
+    def renew(self, client):
+        """Refresh the token now; returns True on success"""
+        with self.lock:
+            refresh_token = self.refresh_token
+        try:
+            data = client.refresh(refresh_token)
+        except requests.HTTPError as e:
+            # 400 means the refresh token itself is no longer valid; retrying cannot help
+            with self.lock:
+                if e.response is not None and e.response.status_code == 400:
+                    self.revoked = True
+                else:
+                    self.retry_at = self.clock() + REFRESH_RETRY_SECONDS
+            logger.warning("Token refresh failed: %s", e)
+            return False
+        except requests.RequestException as e:
+            with self.lock:
+                self.retry_at = self.clock() + REFRESH_RETRY_SECONDS
+            logger.warning("Token refresh failed: %s", e)
+            return False
+        with self.lock:
+            self.id_token = data['id_token']
+            self.refresh_token = data.get('refresh_token', refresh_token)
+            self.expires_at = self.clock() + float(data.get('expires_in', 3600))
+        return True
+
+
+class TokenRefresher:
+    """One background thread renewing the tokens of every signed-in session of the process.
+
+    Tokens are held weakly: a session whose state is dropped simply stops being refreshed.
+    """
+
+    def __init__(self, client, margin=REFRESH_MARGIN_SECONDS, interval=REFRESH_CHECK_SECONDS):
+        self.client = client
+        self.margin = margin
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.tokens = weakref.WeakSet()
+        self.refreshed = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+        self.thread.start()
+
+    def track(self, token):
+        with self.lock:
+            self.tokens.add(token)
+
+    def forget(self, token):
+        with self.lock:
+            self.tokens.discard(token)
+
+    def refresh_due(self):
+        """Renew every tracked token close to expiry; returns how many were renewed"""
+        with self.lock:
+            due = [token for token in self.tokens if token.due(self.margin)]
+        renewed = sum(token.renew(self.client) for token in due)
+        with self.lock:
+            self.refreshed += renewed
+            for token in due:
+                if token.revoked:
+                    self.tokens.discard(token)
+        return renewed
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh_due()
+            except Exception:
+                logger.exception("Token refresh pass failed")
@@ -0,0 +1,179 @@
+"""Local stand-in for the Firebase Auth REST endpoints, for development and load testing.
+
+Serves signUp, signInWithPassword and the securetoken refresh exchange from memory. Point the app
+at it with
+    python auth_stub.py --port 9099 --token-lifetime 600
+    MELODY_MENTOR_AUTH_URL=http://127.0.0.1:9099/v1/accounts \\
+    MELODY_MENTOR_TOKEN_URL=http://127.0.0.1:9099/v1/token streamlit run main.py
+
+or load-test the pooled client against fresh connections per request:
+    python auth_stub.py --load-test 500 --threads 8 --latency 0.005
+"""
+import argparse
+import hashlib
+import json
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from auth_client import AuthClient
+
+
+class AuthStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, token_lifetime=3600):
+        super().__init__(address, AuthStubHandler)
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.lock = threading.Lock()
+        self.users = {}
+        self.refresh_tokens = {}
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def issue(self, user_id):
+        # A fresh ID token and refresh token for a user
+        refresh_token = secrets.token_hex(16)
+        with self.lock:
+            self.refresh_tokens[refresh_token] = user_id
+        return secrets.token_hex(16), refresh_token
+
+
+class AuthStubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests, as the real endpoints do
+    protocol_version = "HTTP/1.1"
+    # Headers and body leave in one segment, so kept-alive connections do not stall on delayed ACKs
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        if path.endswith("/accounts:signUp"):
+            self.sign_up(json.loads(body or b"{}"))
+        elif path.endswith("/accounts:signInWithPassword"):
+            self.sign_in(json.loads(body or b"{}"))
+        elif path.endswith("/token"):
+            self.refresh({key: values[0] for key, values in parse_qs(body.decode()).items()})
+        else:
+            self.reply(404, {"error": {"message": "NOT_FOUND"}})
+
+    def sign_up(self, payload):
+        email, password = payload.get("email"), payload.get("password")
+        with self.server.lock:
+            if email in self.server.users:
+                return self.reply(400, {"error": {"message": "EMAIL_EXISTS"}})
+            user_id = hashlib.sha1(email.encode()).hexdigest()[:28]
+            self.server.users[email] = (user_id, password)
+        self.reply(200, self.account(email, user_id))
+
+    def sign_in(self, payload):
+        email = payload.get("email")
+        with self.server.lock:
+            user = self.server.users.get(email)
+        if user is None:
+            return self.reply(400, {"error": {"message": "EMAIL_NOT_FOUND"}})
+        if user[1] != payload.get("password"):
+            return self.reply(400, {"error": {"message": "INVALID_PASSWORD"}})
+        self.reply(200, self.account(email, user[0]))
+
+    def refresh(self, form):
+        with self.server.lock:
+            user_id = self.server.refresh_tokens.pop(form.get("refresh_token"), None)
+        if form.get("grant_type") != "refresh_token" or user_id is None:
+            return self.reply(400, {"error": {"message": "INVALID_REFRESH_TOKEN"}})
+        id_token, refresh_token = self.server.issue(user_id)
+        self.reply(200, {"id_token": id_token, "refresh_token": refresh_token, "user_id": user_id,
+                         "expires_in": str(self.server.token_lifetime), "token_type": "Bearer"})
+
+    def account(self, email, user_id):
+        id_token, refresh_token = self.server.issue(user_id)
+        return {"localId": user_id, "email": email, "idToken": id_token, "refreshToken": refresh_token,
+                "expiresIn": str(self.server.token_lifetime)}
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _FreshConnections:
+    # requests.post opens a new connection per call, as AuthHandler used to
+    def post(self, url, **kwargs):
+        return requests.post(url, **kwargs)
+
+
+def load_test(server, sign_ins, threads):
+    """Sign in repeatedly with fresh connections and then with the pooled client, and print both rates"""
+    for label, session in (("fresh connection per request", _FreshConnections()), ("pooled session", None)):
+        client = AuthClient("stub-key", f"{server.base_url}/accounts", f"{server.base_url}/token", session=session)
+        client.account("signUp", {"email": "load@test", "password": "secret"})
+        connections_before = server.connections
+
+        def sign_in(_):
+            response = client.account("signInWithPassword", {"email": "load@test", "password": "secret"})
+            client.refresh(response.json()["refreshToken"])
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(sign_in, range(sign_ins)))
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {sign_ins} sign-ins with refresh in {elapsed:.2f} s "
+              f"({sign_ins / elapsed:.0f}/s), {server.connections - connections_before} connections opened")
+        with server.lock:
+            server.users.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve stub Firebase Auth endpoints, or load-test against them")
+    parser.add_argument("--port", type=int, default=9099, help="Port to serve on (0 picks a free one)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per request")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="Seconds until issued ID tokens expire")
+    parser.add_argument("--load-test", type=int, metavar="SIGN_INS",
+                        help="Run this many sign-ins against an in-process server, then exit")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent clients in the load test")
+    args = parser.parse_args()
+
+    port = 0 if args.load_test else args.port
+    server = AuthStubServer(("127.0.0.1", port), latency=args.latency, token_lifetime=args.token_lifetime)
+    if args.load_test:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        load_test(server, args.load_test, args.threads)
+        server.shutdown()
+        return
+
+    print(f"Auth stub listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Score a directory of recorded takes against one reference, without the Streamlit app.
+
+The reference is analysed once (through the feature cache) and the takes are spread over a
+process pool. Results are appended to a CSV or JSONL file as soon as each take finishes, so an
+interrupted run picks up where it stopped when started again with the same output file.
+
+With --calibrate, the feedback bands are then fitted to every take in the output file and written
+as JSON for the app to load through MELODY_MENTOR_FEEDBACK_BANDS (see scoring.calibrate_bands).
+
+Usage:
+    python batch_score.py reference.mp3 submissions/ --output scores.csv --workers 8
+    python batch_score.py reference.mp3 submissions/ --calibrate feedback_bands.json
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_analysis import (LONG_RECORDING_SECONDS, load_audio, audio_duration, analysis_params, vocal_range,
+                            extract_features, segment_notes, compare_features, stream_features, feature_blocks,
+                            compare_feature_streams, give_feedback)
+from feature_cache import FeatureCache, DEFAULT_CACHE_DIR
+from scoring import SCORE_METRICS, calibrate_bands
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+RESULT_FIELDS = ["file", *SCORE_METRICS, "feedback", "seconds", "error"]
+
+# Reference features, set once per worker process by _init_worker
+_reference = None
+
+
+def _init_worker(ref_features, ref_sr):
+    global _reference
+    _reference = {"features": ref_features, "sr": ref_sr,
+                  "pitch_range": vocal_range(ref_features["pitch"]),
+                  "notes": segment_notes(ref_features["pitch"], ref_sr)}
+
+
+def score_take(path):
+    """Score one take against the worker's reference; errors are reported in the result"""
+    start = time.perf_counter()
+    result = {"file": path}
+    try:
+        duration = audio_duration(path)
+        if duration is not None and duration > LONG_RECORDING_SECONDS:
+            # Very long takes are compared block by block to keep worker memory bounded
+            comparison = compare_feature_streams(feature_blocks(_reference["features"]), stream_features(path))
+        else:
+            audio, sr = load_audio(path)
+            if audio is None:
+                raise ValueError("could not decode audio")
+            if sr != _reference["sr"]:
+                raise ValueError(f"decoded at {sr} Hz but the reference is at {_reference['sr']} Hz")
+            features = extract_features(audio, sr, pitch_range=_reference["pitch_range"])
+            comparison = compare_features(_reference["features"], features, sr=sr, ref_notes=_reference["notes"])
+
+        # Streamed comparisons have only the basic metrics; the others are left empty
+        result.update({name: _to_float(comparison.get(name)) for name in SCORE_METRICS})
+        result["feedback"] = give_feedback(comparison)
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _to_float(value):
+    return float(value) if value is not None else None
+
+
+def find_takes(directory):
+    """All audio files under a directory, in a stable order"""
+    takes = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                takes.append(os.path.join(root, name))
+    return sorted(takes)
+
+
+def read_results(output_path):
+    """Rows of an output file written by an earlier or the current run, metrics as floats"""
+    if not os.path.exists(output_path):
+        return []
+    with open(output_path, newline="") as f:
+        if output_path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+            for row in rows:
+                for name in SCORE_METRICS:
+                    row[name] = float(row[name]) if row.get(name) else None
+            return rows
+        rows = []
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                # A line cut short by an interruption
+                continue
+        return rows
+
+
+def completed_takes(output_path):
+    """Files already scored in an earlier run writing to the same output"""
+    return {row["file"] for row in read_results(output_path) if not row.get("error")}
+
+
+class ResultWriter:
+    """Appends results to CSV or JSONL and flushes after every row"""
+
+    def __init__(self, output_path):
+        self.is_csv = output_path.endswith(".csv")
+        write_header = self.is_csv and (not os.path.exists(output_path) or os.path.getsize(output_path) == 0)
+        self.file = open(output_path, "a", newline="")
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, result):
+        if self.is_csv:
+            row = dict(result)
+            row["feedback"] = " | ".join(result.get("feedback") or [])
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(result) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_reference(path, cache_dir=DEFAULT_CACHE_DIR):
+    """Decode the reference and fetch its features from the cache, analysing it on a miss"""
+    with open(path, "rb") as f:
+        ref_bytes = f.read()
+    ref_audio, ref_sr = load_audio(ref_bytes)
+    if ref_audio is None:
+        raise SystemExit(f"Could not decode reference {path}")
+    ref_features = FeatureCache(cache_dir).get_or_compute(ref_bytes, analysis_params(ref_sr),
+                                                          lambda: extract_features(ref_audio, ref_sr))
+    return ref_features, ref_sr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a directory of takes against one reference")
+    parser.add_argument("reference", help="Reference song")
+    parser.add_argument("takes", help="Directory of takes to score (searched recursively)")
+    parser.add_argument("--output", default="scores.jsonl", help="Results file (.csv or .jsonl)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--cache-dir", default=os.environ.get("MELODY_MENTOR_CACHE_DIR", DEFAULT_CACHE_DIR),
+                        help="Feature cache directory")
+    parser.add_argument("--calibrate", metavar="BANDS_JSON",
+                        help="Afterwards, fit the feedback bands to all scored takes and write them here")
+    args = parser.parse_args()
+
+    ref_features, ref_sr = load_reference(args.reference, args.cache_dir)
+
+    done = completed_takes(args.output)
+    pending = [path for path in find_takes(args.takes) if path not in done]
+    if done:
+        print(f"Resuming: {len(done)} takes already scored")
+    print(f"Scoring {len(pending)} takes with {args.workers} workers")
+
+    writer = ResultWriter(args.output)
+    start = time.perf_counter()
+    finished = failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(ref_features, ref_sr)) as executor:
+            futures = [executor.submit(score_take, path) for path in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                writer.write(result)
+                finished += 1
+                if result.get("error"):
+                    failed += 1
+                    print(f"[{finished}/{len(pending)}] {result['file']}: ERROR {result['error']}")
+                else:
+                    print(f"[{finished}/{len(pending)}] {result['file']}: "
+                          f"pitch {result['pitch_deviation']}, {result['seconds']:.1f} s")
+    finally:
+        writer.close()
+        elapsed = time.perf_counter() - start
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        print(f"Scored {finished} takes ({failed} failed) in {elapsed:.1f} s: {rate:.2f} files/second")
+
+    if args.calibrate:
+        scored = [row for row in read_results(args.output) if not row.get("error")]
+        bands = calibrate_bands(scored)
+        with open(args.calibrate, "w") as f:
+            json.dump(bands, f, indent=2)
+        print(f"Feedback bands fitted to {len(scored)} takes written to {args.calibrate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,883 @@
+"""Benchmarks for the audio analysis pipeline.
+
+Usage:
+    python benchmark.py pitch "song refrence files/tera_fitoor.mp3" --duration 30
+    python benchmark.py parallel "song refrence files/tera_fitoor.mp3" --workers 4
+    python benchmark.py spectral "song refrence files/tera_fitoor.mp3"
+    python benchmark.py pipeline --durations 10 60 600 --json pipeline.json
+    python benchmark.py pipeline --compare pipeline.json
+    python benchmark.py startup
+    python benchmark.py sample-rate --durations 10 60
+    python benchmark.py voice-activity "song refrence files/tera_fitoor.mp3"
+    python benchmark.py voice-activity --duration 60
+    python benchmark.py separation "song refrence files/tum_hi(vocals extracted).mp3" --level 1 2
+    python benchmark.py takes --takes 1 4 8 --duration 30
+    python benchmark.py alignment --detunes 0 30 60 --delays 0 0.5
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import librosa
+import numpy as np
+import soundfile
+
+# Benchmarks report peak memory per stage, which the app leaves off; set before the pool workers start
+os.environ.setdefault("MELODY_MENTOR_TRACE_MEMORY", "1")
+
+from audio_analysis import (ANALYSIS_SR, FRAME_LENGTH, HOP_LENGTH, ALIGNMENT_BAND_SECONDS, N_MFCC, PITCH_ENGINES, PARALLEL_TOLERANCE_CENTS,
+                            PARALLEL_TOLERANCE_PITCH_FRACTION, PARALLEL_TOLERANCE_RTOL, load_audio,
+                            estimate_pitch, extract_features, spectral_features, submit_features,
+                            collect_features, compare_features, compare_takes, voice_activity,
+                            DEFAULT_PITCH_ENGINE)
+from instrumentation import span
+from scoring import rank_takes, best_by_phrase
+from separation import SEPARATION_METHODS, isolate_vocals
+
+# Synthetic melodies step through a major scale starting at A3
+FIXTURE_BASE_MIDI = 57
+FIXTURE_SCALE = [0, 2, 4, 5, 7, 9, 11, 12]
+FIXTURE_VIBRATO_HZ = 5.5
+FIXTURE_VIBRATO_CENTS = 30.0
+# The synthetic take is sung this sharp and this late relative to the synthetic reference
+FIXTURE_TAKE_DETUNE_CENTS = 20.0
+FIXTURE_TAKE_DELAY_SECONDS = 0.25
+# A stage counts as regressed when it gets this much slower or hungrier than the baseline run
+REGRESSION_TOLERANCE = 0.25
+REGRESSION_TOLERANCE_CENTS = 5.0
+# Heavy modules a cold start may load; the login page should need none of the analysis ones
+STARTUP_MODULES = ("streamlit", "firebase_admin", "librosa", "scipy.signal", "numba", "matplotlib")
+# Each startup probe runs in a fresh interpreter and prints one JSON object
+STARTUP_PROBES = {
+    "login_page": """
+import json, sys, time
+start = time.perf_counter()
+import streamlit
+imported = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file("main.py", default_timeout=600)
+rendered = time.perf_counter()
+app.run()
+print(json.dumps({"import_streamlit": imported - start, "first_render": time.perf_counter() - rendered,
+                  "modules": [name for name in MODULES if name in sys.modules]}))
+""",
+    "analysis": """
+import json, sys, time
+start = time.perf_counter()
+import audio_analysis, plotting
+imported = time.perf_counter()
+audio_analysis.warm_up()
+cold = time.perf_counter()
+audio_analysis.warm_up()
+print(json.dumps({"import_analysis_stack": imported - start, "first_analysis": cold - imported,
+                  "warm_analysis": time.perf_counter() - cold,
+                  "modules": [name for name in MODULES if name in sys.modules]}))
+""",
+}
+# Analysis rates compared by the sample-rate benchmark: the previous policy (librosa's default
+# 22050 Hz with 2048/512 frames) and the current one, as (sample rate, frame length, hop length)
+SAMPLE_RATE_POLICIES = {
+    "22050 Hz (previous)": (22050, 2048, 512),
+    f"{ANALYSIS_SR} Hz (current)": (ANALYSIS_SR, FRAME_LENGTH, HOP_LENGTH),
+}
+# Without clips, the voice-activity benchmark uses sung phrases separated by rests of quiet room noise
+FIXTURE_PHRASE_SECONDS = 8.0
+FIXTURE_REST_SECONDS = 4.0
+FIXTURE_ROOM_NOISE = 0.001
+# The separation benchmark mixes a clean vocal with a looped accompaniment: a I-IV-V-I progression of
+# harmonic chords, two seconds each, with a noise-burst drum on every half second
+FIXTURE_CHORDS = [[45, 52, 57, 61], [50, 57, 62, 66], [52, 59, 64, 68], [45, 52, 57, 61]]
+FIXTURE_CHORD_SECONDS = 2.0
+FIXTURE_BEAT_SECONDS = 0.5
+# Changes smaller than these are timer and allocator noise, however large they are relatively
+REGRESSION_FLOOR = {"seconds": 0.1, "peak_mb": 1.0}
+
+
+def cents_error(estimated, baseline):
+    """Mean absolute cents difference over frames voiced in both pitch tracks"""
+    length = min(len(estimated), len(baseline))
+    estimated, baseline = estimated[:length], baseline[:length]
+    both_voiced = (estimated > 0) & (baseline > 0)
+    if not np.any(both_voiced):
+        return None
+    return float(np.mean(np.abs(1200 * np.log2(estimated[both_voiced] / baseline[both_voiced]))))
+
+
+def voicing_agreement(estimated, baseline):
+    """Fraction of frames where both trackers agree on voiced/unvoiced"""
+    length = min(len(estimated), len(baseline))
+    return float(np.mean((estimated[:length] > 0) == (baseline[:length] > 0)))
+
+
+def benchmark_pitch_engines(audio, sr, engines=None, baseline="pyin"):
+    """Time every pitch engine on one clip and score it against the baseline engine"""
+    engines = list(engines or PITCH_ENGINES)
+    if baseline not in engines:
+        engines.insert(0, baseline)
+
+    tracks = {}
+    results = []
+    for engine in engines:
+        start = time.perf_counter()
+        pitch, _ = estimate_pitch(audio, sr, engine=engine)
+        elapsed = time.perf_counter() - start
+        tracks[engine] = pitch
+        results.append({"engine": engine, "seconds": elapsed})
+
+    duration = len(audio) / sr
+    for result in results:
+        pitch = tracks[result["engine"]]
+        result["realtime_factor"] = duration / result["seconds"] if result["seconds"] > 0 else None
+        result["cents_error"] = cents_error(pitch, tracks[baseline])
+        result["voicing_agreement"] = voicing_agreement(pitch, tracks[baseline])
+    return results
+
+
+def run_pitch(args):
+    report = []
+    for path in args.clips:
+        audio, sr = load_audio(path)
+        if audio is None:
+            continue
+        if args.duration:
+            audio = audio[:int(args.duration * sr)]
+
+        # Warm-up pass so numba compilation isn't charged to the first engine
+        estimate_pitch(audio[:sr], sr, engine="pyin")
+
+        results = benchmark_pitch_engines(audio, sr, engines=args.engines, baseline=args.baseline)
+        report.append({"clip": path, "duration": len(audio) / sr, "engines": results})
+
+        print(f"\n{path} ({len(audio) / sr:.1f} s)")
+        print(f"{'engine':<14}{'seconds':>10}{'x realtime':>12}{'cents err':>12}{'voicing':>10}")
+        for r in results:
+            cents = f"{r['cents_error']:.1f}" if r["cents_error"] is not None else "N/A"
+            print(f"{r['engine']:<14}{r['seconds']:>10.2f}{r['realtime_factor']:>12.1f}"
+                  f"{cents:>12}{r['voicing_agreement']:>10.1%}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def compare_parallel(serial, parallel):
+    """Check chunked features against the serial ones using the documented tolerances"""
+    report = {}
+    for name in ("rms", "spectral_centroid"):
+        relative = np.abs(serial[name] - parallel[name]) / np.maximum(np.abs(serial[name]), 1e-9)
+        report[f"{name}_max_relative_error"] = float(np.max(relative))
+
+    ref_pitch, par_pitch = serial["pitch"], parallel["pitch"]
+    any_voiced = (ref_pitch > 0) | (par_pitch > 0)
+    both_voiced = (ref_pitch > 0) & (par_pitch > 0)
+    cents = np.full(len(ref_pitch), np.inf)
+    cents[both_voiced] = np.abs(1200 * np.log2(par_pitch[both_voiced] / ref_pitch[both_voiced]))
+    matching = cents <= PARALLEL_TOLERANCE_CENTS
+    report["pitch_matching_fraction"] = float(np.mean(matching[any_voiced])) if np.any(any_voiced) else 1.0
+
+    report["within_tolerance"] = (
+        report["rms_max_relative_error"] <= PARALLEL_TOLERANCE_RTOL
+        and report["spectral_centroid_max_relative_error"] <= PARALLEL_TOLERANCE_RTOL
+        and report["pitch_matching_fraction"] >= PARALLEL_TOLERANCE_PITCH_FRACTION
+    )
+    return report
+
+
+def run_parallel(args):
+    report = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for path in args.clips:
+            audio, sr = load_audio(path)
+            if audio is None:
+                continue
+
+            start = time.perf_counter()
+            serial = extract_features(audio, sr)
+            serial_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parallel = collect_features(submit_features(executor, audio, sr, chunk_seconds=args.chunk_seconds))
+            parallel_seconds = time.perf_counter() - start
+
+            result = compare_parallel(serial, parallel)
+            result.update({"clip": path, "serial_seconds": serial_seconds, "parallel_seconds": parallel_seconds})
+            report.append(result)
+
+            status = "OK" if result["within_tolerance"] else "OUT OF TOLERANCE"
+            print(f"{path}: serial {serial_seconds:.2f} s, parallel {parallel_seconds:.2f} s, "
+                  f"pitch match {result['pitch_matching_fraction']:.2%} [{status}]")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def benchmark_spectral_features(audio, sr):
+    """Time each spectral feature computed on its own against deriving it from the shared STFT"""
+    frame = {"n_fft": FRAME_LENGTH, "hop_length": HOP_LENGTH}
+    standalone = {
+        "rms": lambda: librosa.feature.rms(y=audio, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH),
+        "spectral_centroid": lambda: librosa.feature.spectral_centroid(y=audio, sr=sr, **frame),
+        "spectral_rolloff": lambda: librosa.feature.spectral_rolloff(y=audio, sr=sr, **frame),
+        "spectral_flatness": lambda: librosa.feature.spectral_flatness(y=audio, **frame),
+        "mfcc": lambda: librosa.feature.mfcc(y=audio, sr=sr, n_mfcc=N_MFCC, **frame),
+    }
+
+    S = np.abs(librosa.stft(audio, **frame))
+    stft_seconds = _timed(lambda: np.abs(librosa.stft(audio, **frame)))
+    from_spectrogram = {
+        "rms": lambda: librosa.feature.rms(S=S, frame_length=FRAME_LENGTH),
+        "spectral_centroid": lambda: librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=FRAME_LENGTH),
+        "spectral_rolloff": lambda: librosa.feature.spectral_rolloff(S=S, sr=sr, n_fft=FRAME_LENGTH),
+        "spectral_flatness": lambda: librosa.feature.spectral_flatness(S=S),
+        "mfcc": lambda: librosa.feature.mfcc(
+            S=librosa.power_to_db(librosa.feature.melspectrogram(S=S ** 2, sr=sr, n_fft=FRAME_LENGTH)),
+            n_mfcc=N_MFCC),
+    }
+
+    features = []
+    for name in standalone:
+        alone = _timed(standalone[name])
+        derived = _timed(from_spectrogram[name])
+        features.append({"feature": name, "standalone_seconds": alone, "shared_seconds": derived,
+                         "saved_seconds": alone - derived})
+
+    return {
+        "stft_seconds": stft_seconds,
+        "pipeline_seconds": _timed(lambda: spectral_features(audio, sr)),
+        "standalone_total_seconds": sum(f["standalone_seconds"] for f in features),
+        "features": features,
+    }
+
+
+def run_spectral(args):
+    report = []
+    for path in args.clips:
+        audio, sr = load_audio(path)
+        if audio is None:
+            continue
+        result = benchmark_spectral_features(audio, sr)
+        result["clip"] = path
+        report.append(result)
+
+        print(f"\n{path} ({len(audio) / sr:.1f} s), shared STFT {result['stft_seconds']:.3f} s")
+        print(f"{'feature':<20}{'standalone':>12}{'from STFT':>12}{'saved':>10}")
+        for f in result["features"]:
+            print(f"{f['feature']:<20}{f['standalone_seconds']:>12.3f}{f['shared_seconds']:>12.3f}"
+                  f"{f['saved_seconds']:>10.3f}")
+        print(f"all features: {result['standalone_total_seconds']:.3f} s separately, "
+              f"{result['pipeline_seconds']:.3f} s with the shared STFT")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def synthetic_vocal(duration, sr, seed=0, detune_cents=0.0, delay=0.0):
+    """Synthetic sung melody: a harmonic stack with vibrato following a random stepwise tune, plus breath noise.
+
+    Returns the audio together with the true f0 and the note number of every sample (0 Hz and -1 in rests).
+    The same seed always produces the same tune, so a detuned or delayed take can be made to match a reference.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * sr)
+    f0 = np.zeros(n_samples)
+    note_index = np.full(n_samples, -1, dtype=np.int32)
+
+    position = int(delay * sr)
+    degree = 0
+    note = 0
+    while position < n_samples:
+        degree = int(np.clip(degree + rng.integers(-2, 3), 0, len(FIXTURE_SCALE) - 1))
+        length = int(rng.uniform(0.25, 0.8) * sr)
+        midi = FIXTURE_BASE_MIDI + FIXTURE_SCALE[degree]
+        f0[position:position + length] = librosa.midi_to_hz(midi)
+        note_index[position:position + length] = note
+        note += 1
+        position += length
+        # Roughly a third of the notes are followed by a breath
+        if rng.random() < 0.3:
+            position += int(rng.uniform(0.05, 0.2) * sr)
+
+    voiced = f0 > 0
+    # Vibrato is timed from the start of the tune, so a delayed take is the reference shifted in time
+    t = np.arange(n_samples) / sr - delay
+    f0[voiced] *= 2 ** ((detune_cents + FIXTURE_VIBRATO_CENTS * np.sin(2 * np.pi * FIXTURE_VIBRATO_HZ * t[voiced]))
+                        / 1200)
+
+    # 10 ms attack and release so note boundaries don't click
+    ramp = max(1, int(0.01 * sr))
+    envelope = np.convolve(voiced.astype(np.float32), np.ones(ramp, dtype=np.float32) / ramp, mode="same")
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    audio = np.zeros(n_samples, dtype=np.float32)
+    for harmonic in range(1, 9):
+        below_nyquist = harmonic * f0 < 0.45 * sr
+        audio += (np.sin(harmonic * phase) * below_nyquist / harmonic).astype(np.float32)
+    audio *= envelope
+    audio += rng.normal(0, 0.01, n_samples).astype(np.float32)
+    audio *= 0.5 / np.max(np.abs(audio))
+    return audio, f0, note_index
+
+
+def synthetic_session(duration, sr, seed=0):
+    """Synthetic take alternating sung phrases with rests of room noise, starting and ending with a rest"""
+    rng = np.random.default_rng(seed)
+    rest = int(FIXTURE_REST_SECONDS * sr)
+    parts = [rng.normal(0, FIXTURE_ROOM_NOISE, rest)]
+    phrase = 0
+    while sum(len(part) for part in parts) < duration * sr:
+        vocal, _, _ = synthetic_vocal(FIXTURE_PHRASE_SECONDS, sr, seed=seed + phrase)
+        parts += [vocal, rng.normal(0, FIXTURE_ROOM_NOISE, rest)]
+        phrase += 1
+    return np.concatenate(parts)[:int(duration * sr)].astype(np.float32)
+
+
+def synthetic_accompaniment(n_samples, sr, seed=0):
+    """Looped chords and drums, the kind of repeating backing REPET-SIM is meant to remove"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) / sr
+    audio = np.zeros(n_samples)
+    chord_samples = int(FIXTURE_CHORD_SECONDS * sr)
+    for i, start in enumerate(range(0, n_samples, chord_samples)):
+        bar = slice(start, start + chord_samples)
+        for midi in FIXTURE_CHORDS[i % len(FIXTURE_CHORDS)]:
+            for harmonic in range(1, 6):
+                audio[bar] += np.sin(2 * np.pi * harmonic * librosa.midi_to_hz(midi) * t[bar]) / harmonic
+    hit = int(0.05 * sr)
+    decay = np.exp(-np.arange(hit) / (0.01 * sr))
+    for start in range(0, n_samples, int(FIXTURE_BEAT_SECONDS * sr)):
+        length = min(hit, n_samples - start)
+        audio[start:start + length] += rng.normal(0, 4.0, length) * decay[:length]
+    return audio
+
+
+def true_pitch_at_frames(f0, note_index, fixture_sr, sr, n_frames, hop_length=HOP_LENGTH, frame_length=FRAME_LENGTH):
+    """True f0 at the centre of each analysis frame at rate sr, 0 for frames that touch a rest or a note change"""
+    times = librosa.frames_to_time(np.arange(n_frames), sr=sr, hop_length=hop_length)
+    half_window = frame_length / 2 / sr
+
+    def sample(t):
+        return np.clip((t * fixture_sr).astype(int), 0, len(f0) - 1)
+
+    centre, first, last = sample(times), sample(times - half_window), sample(times + half_window)
+    note = note_index[centre]
+    stable = (note >= 0) & (note_index[first] == note) & (note_index[last] == note)
+    return np.where(stable, f0[centre], 0.0)
+
+
+def _profiled(name, func):
+    # Wall time, CPU time and peak traced allocation of one call
+    with span(name) as stage:
+        result = func()
+    return result, {"seconds": stage.wall_seconds, "cpu_seconds": stage.cpu_seconds,
+                    "peak_mb": stage.peak_bytes / 2 ** 20}
+
+
+def _wav_bytes(audio, sr):
+    buffer = io.BytesIO()
+    soundfile.write(buffer, audio, sr, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def benchmark_pipeline(duration, fixture_sr, engine=None, seed=0, policy=None):
+    """Time and memory-profile load_audio, extract_features and compare_features on a synthetic fixture.
+
+    policy is a (sample rate, frame length, hop length) to analyse at instead of the current parameters.
+    """
+    analysis_sr, frame_length, hop_length = policy or (ANALYSIS_SR, FRAME_LENGTH, HOP_LENGTH)
+    frames = {"frame_length": frame_length, "hop_length": hop_length}
+    band_frames = int(round(ALIGNMENT_BAND_SECONDS * analysis_sr / hop_length))
+    ref_audio, ref_f0, ref_notes = synthetic_vocal(duration, fixture_sr, seed=seed)
+    take_audio, _, _ = synthetic_vocal(duration, fixture_sr, seed=seed, detune_cents=FIXTURE_TAKE_DETUNE_CENTS,
+                                       delay=FIXTURE_TAKE_DELAY_SECONDS)
+    ref_bytes, take_bytes = _wav_bytes(ref_audio, fixture_sr), _wav_bytes(take_audio, fixture_sr)
+    del ref_audio, take_audio
+
+    stages = {}
+    (audio, sr), stages["load_audio"] = _profiled("load_audio", lambda: load_audio(ref_bytes, sr=analysis_sr))
+    features, stages["extract_features"] = _profiled("extract_features",
+                                                     lambda: extract_features(audio, sr, engine=engine, **frames))
+    # The take is analysed outside the timed stages; it only exists to be compared
+    take, take_sr = load_audio(take_bytes, sr=analysis_sr)
+    take_features = extract_features(take, take_sr, engine=engine, **frames)
+    comparison, stages["compare_features"] = _profiled(
+        "compare_features",
+        lambda: compare_features(features, take_features, sr=sr, hop_length=hop_length, band_frames=band_frames))
+
+    # load_audio resamples to the analysis rate, so the true f0 is sampled on the decoded frame grid
+    truth = true_pitch_at_frames(ref_f0, ref_notes, fixture_sr, sr, len(features["pitch"]), **frames)
+    estimated = np.asarray(features["pitch"])
+    both_voiced = (estimated > 0) & (truth > 0)
+    cents = np.abs(1200 * np.log2(estimated[both_voiced] / truth[both_voiced]))
+    deviation = comparison["pitch_deviation"]
+    accuracy = {
+        "cents_error_mean": float(np.mean(cents)) if len(cents) else None,
+        "cents_error_median": float(np.median(cents)) if len(cents) else None,
+        "voiced_recall": float(np.mean(estimated[truth > 0] > 0)) if np.any(truth > 0) else None,
+        "comparison_pitch_deviation": deviation,
+        # The comparison should report roughly the detune the take was synthesised with
+        "comparison_detune_error": abs(deviation - FIXTURE_TAKE_DETUNE_CENTS) if deviation is not None else None,
+    }
+    return {"duration": duration, "fixture_sr": fixture_sr, "analysis_sr": sr, "stages": stages,
+            "accuracy": accuracy}
+
+
+def compare_pipeline_reports(baseline, current, tolerance=REGRESSION_TOLERANCE,
+                             tolerance_cents=REGRESSION_TOLERANCE_CENTS):
+    """List the stages and accuracy figures that got worse than the baseline report allows"""
+    baseline_runs = {(run["duration"], run["fixture_sr"]): run for run in baseline["runs"]}
+    regressions = []
+    for run in current["runs"]:
+        before = baseline_runs.get((run["duration"], run["fixture_sr"]))
+        if before is None:
+            continue
+        fixture = f"{run['duration']:g} s @ {run['fixture_sr']} Hz"
+        for stage, now in run["stages"].items():
+            then = before["stages"].get(stage)
+            if then is None:
+                continue
+            for metric, floor in REGRESSION_FLOOR.items():
+                if now[metric] > then[metric] * (1 + tolerance) and now[metric] - then[metric] > floor:
+                    regressions.append(f"{fixture} {stage} {metric}: {then[metric]:.3f} -> {now[metric]:.3f}")
+        for metric in ("cents_error_mean", "comparison_detune_error"):
+            now, then = run["accuracy"].get(metric), before["accuracy"].get(metric)
+            if now is not None and then is not None and now > then + tolerance_cents:
+                regressions.append(f"{fixture} {metric}: {then:.1f} -> {now:.1f} cents")
+    return regressions
+
+
+def run_pipeline(args):
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "librosa": librosa.__version__,
+            "platform": platform.platform(),
+            "pitch_engine": args.engine or DEFAULT_PITCH_ENGINE,
+        },
+        "runs": [],
+    }
+
+    # Warm-up pass so numba compilation isn't charged to the first fixture
+    warm_up, _, _ = synthetic_vocal(1.0, ANALYSIS_SR)
+    extract_features(warm_up, ANALYSIS_SR, engine=args.engine)
+
+    print(f"{'fixture':<20}{'stage':<20}{'seconds':>10}{'cpu':>10}{'peak MB':>10}")
+    for duration in args.durations:
+        for fixture_sr in args.sample_rates:
+            result = benchmark_pipeline(duration, fixture_sr, engine=args.engine, seed=args.seed)
+            report["runs"].append(result)
+            fixture = f"{duration:g} s @ {fixture_sr} Hz"
+            for stage, timing in result["stages"].items():
+                print(f"{fixture:<20}{stage:<20}{timing['seconds']:>10.3f}{timing['cpu_seconds']:>10.3f}"
+                      f"{timing['peak_mb']:>10.1f}")
+            accuracy = result["accuracy"]
+            mean = f"{accuracy['cents_error_mean']:.1f}" if accuracy["cents_error_mean"] is not None else "N/A"
+            detune = (f"{accuracy['comparison_detune_error']:.1f}"
+                      if accuracy["comparison_detune_error"] is not None else "N/A")
+            print(f"{fixture:<20}accuracy: {mean} cents from true f0, voiced recall "
+                  f"{accuracy['voiced_recall']:.1%}, comparison off the detune by {detune} cents")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_pipeline_reports(baseline, report, tolerance=args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare}")
+
+
+def run_sample_rate(args):
+    report = {"pitch_engine": args.engine or DEFAULT_PITCH_ENGINE, "runs": []}
+
+    # Warm-up pass so numba compilation isn't charged to the first policy
+    warm_up, _, _ = synthetic_vocal(1.0, ANALYSIS_SR)
+    extract_features(warm_up, ANALYSIS_SR, engine=args.engine)
+
+    print(f"{'fixture':<20}{'policy':<22}{'decode s':>10}{'features s':>12}{'compare s':>11}"
+          f"{'cents err':>11}{'recall':>8}{'detune err':>12}")
+    for duration in args.durations:
+        for fixture_sr in args.sample_rates:
+            fixture = f"{duration:g} s @ {fixture_sr} Hz"
+            for name, policy in SAMPLE_RATE_POLICIES.items():
+                result = benchmark_pipeline(duration, fixture_sr, engine=args.engine, seed=args.seed, policy=policy)
+                report["runs"].append({"policy": name, **result})
+                stages, accuracy = result["stages"], result["accuracy"]
+                mean = accuracy["cents_error_mean"]
+                detune = accuracy["comparison_detune_error"]
+                print(f"{fixture:<20}{name:<22}{stages['load_audio']['seconds']:>10.3f}"
+                      f"{stages['extract_features']['seconds']:>12.3f}{stages['compare_features']['seconds']:>11.3f}"
+                      f"{mean if mean is not None else float('nan'):>11.1f}{accuracy['voiced_recall']:>8.1%}"
+                      f"{detune if detune is not None else float('nan'):>12.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def benchmark_voice_activity(audio, sr, engine=None):
+    """Time the pitch tracker over every frame and over the voice-active regions only, and compare the tracks"""
+    start = time.perf_counter()
+    full, _ = estimate_pitch(audio, sr, engine=engine)
+    full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    active = voice_activity(audio, sr)
+    trimmed, _ = estimate_pitch(audio, sr, engine=engine, active=active)
+    trimmed_seconds = time.perf_counter() - start
+
+    return {
+        "duration": len(audio) / sr,
+        "full_seconds": full_seconds,
+        "trimmed_seconds": trimmed_seconds,
+        "speedup": full_seconds / trimmed_seconds if trimmed_seconds > 0 else None,
+        "frames_skipped": 1.0 - float(np.mean(active)),
+        "cents_error": cents_error(trimmed, full),
+        "voicing_agreement": voicing_agreement(trimmed, full),
+        # Frames the full pass called voiced that the pre-pass skipped: pitch found in silence, or lost notes
+        "voiced_frames_skipped": int(np.count_nonzero((full > 0) & ~active)),
+    }
+
+
+def run_voice_activity(args):
+    if args.clips:
+        clips = [(path, *load_audio(path)) for path in args.clips]
+    else:
+        clips = [(f"synthetic {args.duration:g} s", synthetic_session(args.duration, ANALYSIS_SR), ANALYSIS_SR)]
+
+    # Warm-up pass so numba compilation isn't charged to the first clip
+    warm_up, _, _ = synthetic_vocal(1.0, ANALYSIS_SR)
+    estimate_pitch(warm_up, ANALYSIS_SR, engine=args.engine)
+
+    report = []
+    print(f"{'clip':<40}{'seconds':>9}{'full s':>9}{'trimmed s':>11}{'skipped':>9}{'cents err':>11}"
+          f"{'voicing':>9}{'voiced skipped':>16}")
+    for name, audio, sr in clips:
+        if audio is None:
+            continue
+        result = benchmark_voice_activity(audio, sr, engine=args.engine)
+        result["clip"] = name
+        report.append(result)
+        cents = f"{result['cents_error']:.2f}" if result["cents_error"] is not None else "N/A"
+        print(f"{name[-39:]:<40}{result['duration']:>9.1f}{result['full_seconds']:>9.2f}"
+              f"{result['trimmed_seconds']:>11.2f}{result['frames_skipped']:>9.1%}{cents:>11}"
+              f"{result['voicing_agreement']:>9.1%}{result['voiced_frames_skipped']:>16}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def benchmark_separation(vocal, sr, level, engine=None):
+    """Pitch-track a vocal mixed with accompaniment, raw and after each separation method.
+
+    level is the accompaniment's RMS relative to the vocal's. Tracks are scored against the pitch
+    track of the clean vocal.
+    """
+    accompaniment = synthetic_accompaniment(len(vocal), sr)
+    accompaniment *= level * np.sqrt(np.mean(vocal ** 2) / np.mean(accompaniment ** 2))
+    mix = (vocal + accompaniment).astype(np.float32)
+    clean = extract_features(vocal, sr, engine=engine)["pitch"]
+
+    results = []
+    for method in (None,) + SEPARATION_METHODS:
+        start = time.perf_counter()
+        audio = isolate_vocals(mix, sr, method) if method else mix
+        separation_seconds = time.perf_counter() - start
+        features, timing = _profiled("extract_features", lambda: extract_features(audio, sr, engine=engine))
+        pitch = features["pitch"]
+        both_voiced = (pitch > 0) & (clean > 0)
+        cents = np.abs(1200 * np.log2(pitch[both_voiced] / clean[both_voiced]))
+        results.append({
+            "method": method or "none",
+            "separation_seconds": separation_seconds,
+            "features_seconds": timing["seconds"],
+            "voiced_recall": float(np.mean(pitch[clean > 0] > 0)) if np.any(clean > 0) else None,
+            "within_50_cents": float(np.mean(cents <= 50)) if len(cents) else None,
+            "cents_error_median": float(np.median(cents)) if len(cents) else None,
+        })
+    return results
+
+
+def run_separation(args):
+    # Warm-up pass so numba compilation isn't charged to the first mix
+    warm_up, _, _ = synthetic_vocal(1.0, ANALYSIS_SR)
+    extract_features(warm_up, ANALYSIS_SR, engine=args.engine)
+
+    report = []
+    print(f"{'clip':<32}{'level':>7}{'method':>11}{'separate s':>12}{'features s':>12}{'recall':>9}"
+          f"{'within 50c':>12}{'median c':>10}")
+    for path in args.clips:
+        vocal, sr = load_audio(path)
+        if vocal is None:
+            continue
+        if args.duration:
+            vocal = vocal[:int(args.duration * sr)]
+        for level in args.level:
+            for result in benchmark_separation(vocal, sr, level, engine=args.engine):
+                result.update({"clip": path, "level": level})
+                report.append(result)
+                within = result["within_50_cents"]
+                median = result["cents_error_median"]
+                print(f"{path[-31:]:<32}{level:>7g}{result['method']:>11}{result['separation_seconds']:>12.2f}"
+                      f"{result['features_seconds']:>12.2f}{result['voiced_recall']:>9.1%}"
+                      f"{within if within is not None else float('nan'):>12.1%}"
+                      f"{median if median is not None else float('nan'):>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def benchmark_takes(duration, n_takes, executor, seed=0):
+    """Compare N takes with one reference, one analysis per take and all in one batch.
+
+    One analysis per take extracts the reference every time, as separate uncached jobs would. The
+    batch extracts it once and fans the chunks of every take out to the pool together.
+    """
+    reference, _, _ = synthetic_vocal(duration, ANALYSIS_SR, seed=seed)
+    takes = [synthetic_vocal(duration, ANALYSIS_SR, seed=seed, detune_cents=FIXTURE_TAKE_DETUNE_CENTS * i,
+                             delay=FIXTURE_TAKE_DELAY_SECONDS)[0] for i in range(n_takes)]
+
+    start = time.perf_counter()
+    for take in takes:
+        ref_features = collect_features(submit_features(executor, reference, ANALYSIS_SR))
+        compare_features(ref_features, collect_features(submit_features(executor, take, ANALYSIS_SR)))
+    separate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ref_pending = submit_features(executor, reference, ANALYSIS_SR)
+    take_pending = [submit_features(executor, take, ANALYSIS_SR) for take in takes]
+    ref_features = collect_features(ref_pending)
+    take_features = [collect_features(pending) for pending in take_pending]
+    comparisons = compare_takes(ref_features, take_features)
+    ranking = rank_takes(comparisons)
+    best_by_phrase(ref_features, take_features, ANALYSIS_SR, HOP_LENGTH)
+    batched_seconds = time.perf_counter() - start
+
+    return {
+        "duration": duration,
+        "takes": n_takes,
+        "separate_seconds": separate_seconds,
+        "batched_seconds": batched_seconds,
+        "speedup": separate_seconds / batched_seconds if batched_seconds > 0 else None,
+        # The least detuned take should come first
+        "ranked_correctly": ranking == list(range(n_takes)),
+    }
+
+
+def benchmark_alignment(duration, detune_cents, delay, engine=None, seed=0):
+    """Compare a take of known detune and delay with its reference, with and without DTW alignment.
+
+    The aligned pitch deviation should match the detune: alignment may absorb the delay, never the
+    detune. drift_frames is how far the path strays from the take's true lag.
+    """
+    reference, _, _ = synthetic_vocal(duration, ANALYSIS_SR, seed=seed)
+    take, _, _ = synthetic_vocal(duration, ANALYSIS_SR, seed=seed, detune_cents=detune_cents, delay=delay)
+    ref_features = extract_features(reference, ANALYSIS_SR, engine=engine)
+    take_features = extract_features(take, ANALYSIS_SR, engine=engine)
+    aligned = compare_features(ref_features, take_features)
+    unaligned = compare_features(ref_features, take_features, align=False)
+
+    path = aligned.get("alignment_path")
+    lag = round(delay * ANALYSIS_SR / HOP_LENGTH)
+    deviation = aligned["pitch_deviation"]
+    return {
+        "duration": duration,
+        "detune_cents": detune_cents,
+        "delay": delay,
+        "pitch_deviation": deviation,
+        "unaligned_pitch_deviation": unaligned["pitch_deviation"],
+        "detune_error": abs(deviation - detune_cents) if deviation is not None else None,
+        "in_tune_ratio": aligned["in_tune_ratio"],
+        # Measured once the take has started; before that there is nothing to align
+        "drift_frames": (int(np.max(np.abs(path[path[:, 1] >= lag, 1] - path[path[:, 1] >= lag, 0] - lag)))
+                         if path is not None else None),
+    }
+
+
+def run_alignment(args):
+    report = []
+    print(f"{'detune':>8}{'delay':>7}{'deviation':>11}{'unaligned':>11}{'error':>8}{'in tune':>9}{'drift':>7}")
+    for delay in args.delays:
+        for detune in args.detunes:
+            result = benchmark_alignment(args.duration, detune, delay, engine=args.engine, seed=args.seed)
+            report.append(result)
+            print(f"{detune:>8g}{delay:>7g}{result['pitch_deviation']:>11.1f}"
+                  f"{result['unaligned_pitch_deviation']:>11.1f}{result['detune_error']:>8.1f}"
+                  f"{result['in_tune_ratio']:>9.0%}{result['drift_frames']:>7}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    # Exit non-zero when alignment hides part of a detune, so CI can run this as a check
+    worst = max(result["detune_error"] for result in report)
+    if worst > args.tolerance:
+        sys.exit(f"Aligned pitch deviation is {worst:.1f} cents off the synthesised detune")
+
+
+def run_takes(args):
+    report = []
+    print(f"{'seconds':>9}{'takes':>7}{'separate s':>12}{'batched s':>11}{'speedup':>9}{'ranked':>8}")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Warm-up pass so worker start-up and numba compilation aren't charged to the first run
+        warm_up, _, _ = synthetic_vocal(1.0, ANALYSIS_SR)
+        collect_features(submit_features(executor, warm_up, ANALYSIS_SR))
+        for n_takes in args.takes:
+            result = benchmark_takes(args.duration, n_takes, executor, seed=args.seed)
+            report.append(result)
+            print(f"{result['duration']:>9.1f}{n_takes:>7}{result['separate_seconds']:>12.2f}"
+                  f"{result['batched_seconds']:>11.2f}{result['speedup']:>9.2f}"
+                  f"{'yes' if result['ranked_correctly'] else 'no':>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def _startup_probe(code):
+    # Without the warm-up thread and Firebase credentials, so the probe measures the page itself
+    env = {**os.environ, "MELODY_MENTOR_WARM_UP": "0", "MELODY_MENTOR_FAKE_FIRESTORE": "1"}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, "-c", f"MODULES = {STARTUP_MODULES!r}\n{code}"], cwd=directory,
+                            env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_startup(args):
+    report = {}
+    for name, code in STARTUP_PROBES.items():
+        runs = [_startup_probe(code) for _ in range(args.repeat)]
+        # Every run starts cold, so the fastest one is the least disturbed by the machine
+        timings = {key: min(run[key] for run in runs) for key in runs[0] if key != "modules"}
+        report[name] = {**timings, "modules": runs[0]["modules"]}
+        for key, seconds in timings.items():
+            print(f"{name:<12}{key:<24}{seconds:>8.2f} s")
+        print(f"{name:<12}{'heavy modules loaded':<24}{', '.join(runs[0]['modules']) or 'none'}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Melody Mentor performance benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pitch_parser = subparsers.add_parser("pitch", help="Compare pitch engines for speed and cents error")
+    pitch_parser.add_argument("clips", nargs="+", help="Audio files to analyse")
+    pitch_parser.add_argument("--engines", nargs="+", choices=list(PITCH_ENGINES), help="Engines to run")
+    pitch_parser.add_argument("--baseline", default="pyin", choices=list(PITCH_ENGINES),
+                              help="Engine treated as ground truth")
+    pitch_parser.add_argument("--duration", type=float, help="Only analyse the first N seconds of each clip")
+    pitch_parser.add_argument("--json", help="Also write the report to this JSON file")
+    pitch_parser.set_defaults(func=run_pitch)
+
+    parallel_parser = subparsers.add_parser("parallel", help="Compare chunked parallel extraction to the serial path")
+    parallel_parser.add_argument("clips", nargs="+", help="Audio files to analyse")
+    parallel_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parallel_parser.add_argument("--chunk-seconds", type=float, default=30.0, help="Chunk length in seconds")
+    parallel_parser.add_argument("--json", help="Also write the report to this JSON file")
+    parallel_parser.set_defaults(func=run_parallel)
+
+    spectral_parser = subparsers.add_parser("spectral", help="Time spectral features with and without a shared STFT")
+    spectral_parser.add_argument("clips", nargs="+", help="Audio files to analyse")
+    spectral_parser.add_argument("--json", help="Also write the report to this JSON file")
+    spectral_parser.set_defaults(func=run_spectral)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time and memory-profile each stage on synthetic vocals")
+    pipeline_parser.add_argument("--durations", nargs="+", type=float, default=[10, 60, 600],
+                                 help="Fixture lengths in seconds")
+    pipeline_parser.add_argument("--sample-rates", nargs="+", type=int, default=[16000, 44100],
+                                 help="Sample rates the fixtures are encoded at")
+    pipeline_parser.add_argument("--engine", choices=list(PITCH_ENGINES), help="Pitch engine to run")
+    pipeline_parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic melodies")
+    pipeline_parser.add_argument("--json", help="Also write the report to this JSON file")
+    pipeline_parser.add_argument("--compare", help="Baseline report; exit non-zero if any stage regressed")
+    pipeline_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                                 help="Allowed relative slowdown or memory growth before a stage counts as regressed")
+    pipeline_parser.set_defaults(func=run_pipeline)
+
+    rate_parser = subparsers.add_parser("sample-rate",
+                                        help="Compare speed and accuracy of the previous and current analysis rate")
+    rate_parser.add_argument("--durations", nargs="+", type=float, default=[10, 60],
+                             help="Fixture lengths in seconds")
+    rate_parser.add_argument("--sample-rates", nargs="+", type=int, default=[44100],
+                             help="Sample rates the fixtures are encoded at")
+    rate_parser.add_argument("--engine", choices=list(PITCH_ENGINES), help="Pitch engine to run")
+    rate_parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic melodies")
+    rate_parser.add_argument("--json", help="Also write the report to this JSON file")
+    rate_parser.set_defaults(func=run_sample_rate)
+
+    activity_parser = subparsers.add_parser("voice-activity",
+                                            help="Time pitch tracking with and without the voice-activity pre-pass")
+    activity_parser.add_argument("clips", nargs="*", help="Audio files to analyse (default: a synthetic take with rests)")
+    activity_parser.add_argument("--duration", type=float, default=60.0, help="Length of the synthetic take in seconds")
+    activity_parser.add_argument("--engine", choices=list(PITCH_ENGINES), help="Pitch engine to run")
+    activity_parser.add_argument("--json", help="Also write the report to this JSON file")
+    activity_parser.set_defaults(func=run_voice_activity)
+
+    separation_parser = subparsers.add_parser("separation",
+                                              help="Pitch accuracy on a vocal mixed with accompaniment, with and "
+                                                   "without vocal isolation")
+    separation_parser.add_argument("clips", nargs="+", help="Clean (a cappella) vocal recordings")
+    separation_parser.add_argument("--level", nargs="+", type=float, default=[1.0],
+                                   help="Accompaniment RMS relative to the vocal")
+    separation_parser.add_argument("--duration", type=float, help="Only use the first N seconds of each clip")
+    separation_parser.add_argument("--engine", choices=list(PITCH_ENGINES), help="Pitch engine to run")
+    separation_parser.add_argument("--json", help="Also write the report to this JSON file")
+    separation_parser.set_defaults(func=run_separation)
+
+    takes_parser = subparsers.add_parser("takes", help="Time several takes against one reference, one by one and "
+                                                       "batched")
+    takes_parser.add_argument("--takes", nargs="+", type=int, default=[1, 4, 8], help="Numbers of takes to compare")
+    takes_parser.add_argument("--duration", type=float, default=30.0, help="Length of the synthetic clips in seconds")
+    takes_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    takes_parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic melodies")
+    takes_parser.add_argument("--json", help="Also write the report to this JSON file")
+    takes_parser.set_defaults(func=run_takes)
+
+    alignment_parser = subparsers.add_parser("alignment",
+                                             help="Check that DTW alignment absorbs a take's delay but not its detune")
+    alignment_parser.add_argument("--detunes", nargs="+", type=float, default=[0, 30, 60],
+                                  help="Detunes of the synthetic takes in cents")
+    alignment_parser.add_argument("--delays", nargs="+", type=float, default=[0.0, 0.5],
+                                  help="Delays of the synthetic takes in seconds")
+    alignment_parser.add_argument("--duration", type=float, default=20.0, help="Length of the synthetic clips in seconds")
+    alignment_parser.add_argument("--engine", choices=list(PITCH_ENGINES), help="Pitch engine to run")
+    alignment_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE_CENTS,
+                                  help="Largest allowed gap in cents between the reported deviation and the detune")
+    alignment_parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic melodies")
+    alignment_parser.add_argument("--json", help="Also write the report to this JSON file")
+    alignment_parser.set_defaults(func=run_alignment)
+
+    startup_parser = subparsers.add_parser("startup", help="Time a cold start of the app and of the analysis stack")
+    startup_parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per probe")
+    startup_parser.add_argument("--json", help="Also write the report to this JSON file")
+    startup_parser.set_defaults(func=run_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""In-memory stand-in for the subset of the Firestore client the app uses.
+
+Used for local development without Firebase credentials and for load-testing the write path.
+Documents live in a dict keyed by path. Writes can be slowed down and made to fail at random,
+mimicking a remote service. Field transforms such as Increment and Minimum are recognised by their
+class name, so the real firebase_admin.firestore transform objects work unchanged.
+"""
+import copy
+import random
+import threading
+import time
+import uuid
+
+
+class FakeServiceUnavailable(Exception):
+    """Raised by a commit when a simulated failure is injected"""
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.documents = {}
+        self.commits = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def _round_trip(self):
+        # Every call to the service costs latency and may fail before anything is applied
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise FakeServiceUnavailable("simulated failure")
+
+    def _apply(self, writes):
+        # Applies (kind, path, data, merge) writes atomically
+        with self.lock:
+            staged = {path: copy.deepcopy(self.documents.get(path)) for _, path, _, _ in writes}
+            for kind, path, data, merge in writes:
+                current = staged[path]
+                if kind == "update" and current is None:
+                    raise KeyError(f"No document to update: {path}")
+                if kind == "set" and not merge:
+                    current = {}
+                staged[path] = _apply_fields(current or {}, data, dotted=kind == "update")
+            self.documents.update(staged)
+            self.commits += 1
+
+
+class FakeQuery:
+    def __init__(self, db, path, orders=(), limit_count=None, cursor=None):
+        self.db = db
+        self.path = path
+        self.orders = list(orders)
+        self.limit_count = limit_count
+        self.cursor = cursor
+
+    def _copy(self, **changes):
+        fields = {"orders": self.orders, "limit_count": self.limit_count, "cursor": self.cursor, **changes}
+        return FakeQuery(self.db, self.path, **fields)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self.orders + [(field, direction)])
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, snapshot):
+        return self._copy(cursor=snapshot)
+
+    def stream(self):
+        self.db._round_trip()
+        prefix = self.path + "/"
+        with self.db.lock:
+            documents = [(path, copy.deepcopy(data)) for path, data in self.db.documents.items()
+                         if path.startswith(prefix) and "/" not in path[len(prefix):]]
+        documents.sort(key=lambda item: item[0])
+        # Stable sorts applied last-to-first give a multi-field ordering
+        for field, direction in reversed(self.orders):
+            documents.sort(key=lambda item: _field(item[1], field), reverse=_descending(direction))
+        if self.cursor is not None:
+            after = [path for path, _ in documents].index(self.cursor.reference.path) + 1
+            documents = documents[after:]
+        if self.limit_count is not None:
+            documents = documents[:self.limit_count]
+        return [FakeDocumentSnapshot(FakeDocumentReference(self.db, path), data) for path, data in documents]
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self.db, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.db, f"{self.path}/{name}")
+
+    def get(self):
+        self.db._round_trip()
+        with self.db.lock:
+            data = copy.deepcopy(self.db.documents.get(self.path))
+        return FakeDocumentSnapshot(self, data)
+
+    def set(self, data, merge=False):
+        self.db._round_trip()
+        self.db._apply([("set", self.path, data, merge)])
+
+    def update(self, data):
+        self.db._round_trip()
+        self.db._apply([("update", self.path, data, True)])
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append(("set", reference.path, data, merge))
+
+    def update(self, reference, data):
+        self.writes.append(("update", reference.path, data, True))
+
+    def commit(self):
+        self.db._round_trip()
+        self.db._apply(self.writes)
+        self.writes = []
+
+
+def _apply_fields(document, data, dotted):
+    # update() treats "a.b" keys as nested paths; set(merge=True) merges nested dicts instead
+    for key, value in data.items():
+        path = key.split(".") if dotted else [key]
+        target = document
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        field = path[-1]
+        if isinstance(value, dict) and not dotted:
+            target[field] = _apply_fields(target.get(field) or {}, value, dotted=False)
+        else:
+            target[field] = _transform(target.get(field), value)
+    return document
+
+
+def _field(data, dotted_path):
+    for part in dotted_path.split("."):
+        data = (data or {}).get(part)
+    return data
+
+
+def _descending(direction):
+    # Accepts firestore.Query.DESCENDING (the string "DESCENDING") or the bare string
+    return str(direction).upper() == "DESCENDING"
+
+
+def _transform(current, value):
+    # Field transforms are matched by class name so the real firestore.Increment etc. are understood
+    kind = type(value).__name__
+    if kind == "Increment":
+        return (current or 0) + value.value
+    if kind == "Minimum":
+        return value.value if current is None else min(current, value.value)
+    if kind == "Maximum":
+        return value.value if current is None else max(current, value.value)
+    return copy.deepcopy(value)
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "melody_mentor", "features")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class FeatureCache:
+    """Persistent, size-bounded cache of extracted features keyed by audio content"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, audio_bytes, params):
+        """Build a cache key from the raw audio bytes and the analysis parameters"""
+        audio_digest = hashlib.sha256(audio_bytes).hexdigest()
+        param_string = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(f"{audio_digest}:{param_string}".encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached features for a key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                features = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Truncated or corrupted entry: drop it and recompute
+            self._remove(path)
+            return None
+
+        # Touch the entry so eviction treats it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return features
+
+    def put(self, key, features):
+        """Store features under a key and evict old entries if over budget"""
+        arrays = {}
+        for name, value in features.items():
+            value = np.asarray(value)
+            # float32 is plenty for pitch/RMS/centroid and halves the footprint
+            if value.dtype == np.float64:
+                value = value.astype(np.float32)
+            arrays[name] = value
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+
+        self._evict()
+
+    def get_or_compute(self, audio_bytes, params, compute):
+        """Return cached features, calling compute() and storing the result on a miss"""
+        key = self.key(audio_bytes, params)
+        features = self.get(key)
+        if features is None:
+            features = compute()
+            if features is not None:
+                self.put(key, features)
+        return features
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _evict(self):
+        # Least recently used entries go first until the cache fits its budget
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,298 @@
+"""Background, batched writes of analysis results to Firestore.
+
+Saving an analysis used to take two synchronous round trips on the Streamlit thread. Now the
+analysis document, the user's counter and the per-song progress aggregate go out together in one
+batched commit, made on a writer thread with retries, so feedback renders without waiting for the service.
+
+Load test against the in-memory backend:
+    python firestore_writer.py --writes 2000 --users 50 --latency 0.02 --failure-rate 0.1
+"""
+import argparse
+import atexit
+import hashlib
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+logger = logging.getLogger("melody_mentor.firestore")
+
+WRITE_ATTEMPTS = 5
+# Exponential backoff between attempts, with full jitter
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 8.0
+# Saves beyond this many waiting are rejected instead of growing memory without bound
+MAX_QUEUED_WRITES = 1000
+# How long process exit waits for queued writes
+SHUTDOWN_TIMEOUT_SECONDS = 5.0
+# Per-song aggregates: metrics summarised, size of the recent-score ring buffer, and the origin of
+# the day axis used for trends (a recent origin keeps the least-squares sums well conditioned)
+AGGREGATE_METRICS = ('pitch_deviation', 'rms_deviation', 'spectral_centroid_deviation')
+RECENT_SCORES = 10
+TREND_EPOCH = datetime(2024, 1, 1)
+
+
+def song_key(reference_file_name):
+    """Document ID of a song's aggregate: readable, and safe for any file name"""
+    name = reference_file_name or 'Unknown'
+    slug = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")[:40] or "song"
+    return f"{slug}-{hashlib.sha1(name.encode()).hexdigest()[:8]}"
+
+
+def _days(timestamp):
+    # Days since TREND_EPOCH. Analyses are saved and read back as aware UTC datetimes; naive ones, from
+    # older callers, are taken to be UTC already
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - TREND_EPOCH).total_seconds() / 86400
+
+
+def _aggregate_changes(analysis_data, count_before):
+    # How one analysis changes its song's aggregate, as (field path, operation, value) triples.
+    # Operations are 'set', 'increment' and 'minimum', matching Firestore's field transforms.
+    timestamp = analysis_data['timestamp']
+    t = _days(timestamp)
+    slot = str(count_before % RECENT_SCORES)
+    changes = [
+        (('reference_file_name',), 'set', analysis_data.get('reference_file_name', 'Unknown')),
+        (('count',), 'increment', 1),
+        (('last_timestamp',), 'set', timestamp),
+        (('recent', slot, 'timestamp'), 'set', timestamp),
+    ]
+    for metric in AGGREGATE_METRICS:
+        y = analysis_data.get(metric)
+        changes.append((('recent', slot, metric), 'set', y))
+        if y is None:
+            continue
+        # Running sums for the mean and for a least-squares trend over time
+        changes += [
+            ((metric, 'best'), 'minimum', y),
+            ((metric, 'n'), 'increment', 1),
+            ((metric, 'sum_y'), 'increment', y),
+            ((metric, 'sum_t'), 'increment', t),
+            ((metric, 'sum_tt'), 'increment', t * t),
+            ((metric, 'sum_ty'), 'increment', t * y),
+        ]
+    return changes
+
+
+def aggregate_update(analysis_data, count_before):
+    """Payload for set(merge=True) that folds one analysis into its song's aggregate document"""
+    transforms = {'increment': firestore.Increment, 'minimum': firestore.Minimum, 'set': lambda value: value}
+    update = {}
+    for path, operation, value in _aggregate_changes(analysis_data, count_before):
+        target = update
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        target[path[-1]] = transforms[operation](value)
+    return update
+
+
+def fold_aggregate(aggregate, analysis_data):
+    """Apply one analysis to an aggregate held locally, exactly as aggregate_update does in Firestore"""
+    for path, operation, value in _aggregate_changes(analysis_data, aggregate.get('count', 0)):
+        target = aggregate
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        current = target.get(path[-1])
+        if operation == 'increment':
+            value = (current or 0) + value
+        elif operation == 'minimum' and current is not None:
+            value = min(current, value)
+        target[path[-1]] = value
+    return aggregate
+
+
+def summarize_song(aggregate):
+    """Count, best, mean and trend per day of each metric, and the recent scores oldest first"""
+    summary = {
+        'reference_file_name': aggregate.get('reference_file_name', 'Unknown'),
+        'count': aggregate.get('count', 0),
+        'last_timestamp': aggregate.get('last_timestamp'),
+        'recent': sorted((entry for entry in (aggregate.get('recent') or {}).values() if entry.get('timestamp')),
+                         key=lambda entry: entry['timestamp']),
+    }
+    for metric in AGGREGATE_METRICS:
+        sums = aggregate.get(metric) or {}
+        n = sums.get('n', 0)
+        if not n:
+            summary[metric] = None
+            continue
+        # Least-squares slope of the metric against days; undefined until analyses span some time
+        spread = n * sums['sum_tt'] - sums['sum_t'] ** 2
+        trend = (n * sums['sum_ty'] - sums['sum_t'] * sums['sum_y']) / spread if spread > 1e-9 else None
+        summary[metric] = {'best': sums['best'], 'mean': sums['sum_y'] / n, 'trend_per_day': trend}
+    return summary
+
+
+def write_analysis(db, user_id, analysis_id, analysis_data):
+    """Store one analysis, bump the user's analysis count and update the song's aggregate in one batch.
+
+    The song aggregate is read first (one document) to pick the ring-buffer slot for the new score.
+    Saves are serialised by the writer thread, so two analyses never race for the same slot.
+    The analysis ID is chosen by the caller, so retrying after an ambiguous failure rewrites the same
+    document. The counters can still be incremented twice if a commit succeeded but its reply was lost.
+    """
+    user_ref = db.collection('users').document(user_id)
+    song_ref = user_ref.collection('songs').document(song_key(analysis_data.get('reference_file_name')))
+    song = song_ref.get()
+    count_before = song.to_dict().get('count', 0) if song.exists else 0
+
+    batch = db.batch()
+    batch.set(user_ref.collection('analyses').document(analysis_id), analysis_data)
+    # merge=True creates the user document if sign-up never wrote it, where update() would fail the batch
+    batch.set(user_ref, {'total_analyses': firestore.Increment(1)}, merge=True)
+    batch.set(song_ref, aggregate_update(analysis_data, count_before), merge=True)
+    batch.commit()
+
+
+def rebuild_song_aggregates(db, user_id):
+    """Recompute every song aggregate of a user from their raw analyses; returns the number of songs.
+
+    Needed once for analyses saved before aggregates existed. Reads every analysis, so it is not
+    part of the normal page load.
+    """
+    user_ref = db.collection('users').document(user_id)
+    aggregates = {}
+    for doc in user_ref.collection('analyses').order_by('timestamp').stream():
+        analysis = doc.to_dict()
+        if analysis.get('timestamp') is None:
+            continue
+        key = song_key(analysis.get('reference_file_name'))
+        fold_aggregate(aggregates.setdefault(key, {}), analysis)
+
+    batch = db.batch()
+    for key, aggregate in aggregates.items():
+        batch.set(user_ref.collection('songs').document(key), aggregate)
+    batch.commit()
+    return len(aggregates)
+
+
+class FirestoreWriter:
+    """Queue of analysis writes drained by one background thread"""
+
+    def __init__(self, db, attempts=WRITE_ATTEMPTS, base_delay=RETRY_BASE_SECONDS, max_delay=RETRY_MAX_SECONDS,
+                 max_queued=MAX_QUEUED_WRITES):
+        self.db = db
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.failed = Counter()
+        self.written = 0
+        self.retries = 0
+        self.thread = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush, SHUTDOWN_TIMEOUT_SECONDS)
+
+    def submit(self, user_id, analysis_data):
+        """Queue an analysis for saving; returns its document ID or raises queue.Full when backed up"""
+        analysis_id = uuid.uuid4().hex
+        with self.lock:
+            self.pending[user_id] += 1
+        try:
+            self.queue.put_nowait((user_id, analysis_id, analysis_data))
+        except queue.Full:
+            with self.lock:
+                self.pending[user_id] -= 1
+            raise
+        return analysis_id
+
+    def pending_for(self, user_id):
+        """Analyses of this user still waiting to be written"""
+        with self.lock:
+            return self.pending[user_id]
+
+    def failed_for(self, user_id):
+        """Analyses of this user that could not be written after every retry"""
+        with self.lock:
+            return self.failed[user_id]
+
+    def flush(self, timeout=None):
+        """Wait until every queued write has been attempted; returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run(self):
+        while True:
+            user_id, analysis_id, analysis_data = self.queue.get()
+            try:
+                self._write_with_retry(user_id, analysis_id, analysis_data)
+            finally:
+                with self.lock:
+                    self.pending[user_id] -= 1
+                self.queue.task_done()
+
+    def _write_with_retry(self, user_id, analysis_id, analysis_data):
+        for attempt in range(self.attempts):
+            try:
+                write_analysis(self.db, user_id, analysis_id, analysis_data)
+                with self.lock:
+                    self.written += 1
+                return
+            except Exception as e:
+                if attempt + 1 == self.attempts:
+                    logger.error("Giving up on analysis %s for user %s: %s", analysis_id, user_id, e)
+                    with self.lock:
+                        self.failed[user_id] += 1
+                    return
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.warning("Write of analysis %s failed (%s); retrying in %.2f s", analysis_id, e, delay)
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+
+
+def main():
+    from fake_firestore import FakeFirestore
+
+    parser = argparse.ArgumentParser(description="Load-test the analysis write path against an in-memory Firestore")
+    parser.add_argument("--writes", type=int, default=1000, help="Analyses to save")
+    parser.add_argument("--users", type=int, default=20, help="Distinct users the analyses are spread over")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per commit")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="Fraction of commits that fail")
+    args = parser.parse_args()
+    # Retries are expected here; only report writes that were given up on
+    logging.basicConfig(level=logging.ERROR)
+
+    db = FakeFirestore(latency=args.latency, failure_rate=args.failure_rate, seed=0)
+    writer = FirestoreWriter(db, base_delay=0.01, max_delay=0.1, max_queued=args.writes)
+
+    start = time.perf_counter()
+    submit_seconds = []
+    for i in range(args.writes):
+        submitted = time.perf_counter()
+        writer.submit(f"user-{i % args.users}", {'reference_file_name': f"song {i % 7}",
+                                                 'pitch_deviation': float(i % 200),
+                                                 'timestamp': datetime.now(timezone.utc)})
+        submit_seconds.append(time.perf_counter() - submitted)
+    queued = time.perf_counter() - start
+    writer.flush()
+    elapsed = time.perf_counter() - start
+
+    counted = sum(db.documents.get(f"users/user-{u}", {}).get('total_analyses', 0) for u in range(args.users))
+    stored = sum(1 for path in db.documents if "/analyses/" in path)
+    print(f"queued {args.writes} saves in {queued * 1000:.1f} ms "
+          f"(max {max(submit_seconds) * 1000:.2f} ms per save on the caller's thread)")
+    print(f"written {writer.written}, failed {sum(writer.failed.values())}, retries {writer.retries}, "
+          f"commits {db.commits} in {elapsed:.2f} s ({writer.written / elapsed:.0f} writes/s)")
+    songs = sum(1 for path in db.documents if "/songs/" in path)
+    aggregated = sum(data.get('count', 0) for path, data in db.documents.items() if "/songs/" in path)
+    print(f"analysis documents {stored}, counters total {counted}, {songs} song aggregates covering {aggregated}")
+
+
+if __name__ == "__main__":
+    main()
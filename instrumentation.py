@@ -0,0 +1,184 @@
+"""Lightweight timing and memory spans for the analysis stages.
+
+Wrap a stage in ``with span("decode"):`` or decorate a function with ``@span("plot")``. A span opened
+inside another one becomes its child. When an outermost span closes, the whole tree is written to the
+``melody_mentor.performance`` logger as one JSON line.
+
+Each span records wall time, the CPU time of this process and, when TRACE_MEMORY is on, the peak memory
+allocated while it was open. Memory is tracked with tracemalloc, and a child's peak is counted in the
+peak of every span that encloses it. Work done in the analysis process pool is invisible here until the
+workers send their spans back; see adopt().
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger("melody_mentor.performance")
+
+# tracemalloc slows allocation-heavy code down (about 12% on feature extraction), so the app records
+# times only. Set MELODY_MENTOR_TRACE_MEMORY=1 to record peaks as well; benchmark.py does.
+TRACE_MEMORY = os.environ.get("MELODY_MENTOR_TRACE_MEMORY", "0") == "1"
+# Samples kept per stage for the session percentiles
+STATS_WINDOW = 200
+
+_local = threading.local()
+# tracemalloc is process-wide, so it runs while any thread has an outermost span open. Peaks are
+# approximate when several sessions analyse at the same time.
+_tracing_lock = threading.Lock()
+_tracing_roots = 0
+_started_tracing = False
+
+
+class Span:
+    """Timing of one stage and of the stages nested inside it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_bytes = 0
+        self.children = []
+        self._traced_base = None
+
+    def rows(self, prefix=""):
+        """(depth, path, span) for this span and every descendant, depth first"""
+        path = f"{prefix}/{self.name}" if prefix else self.name
+        rows = [(path.count("/"), path, self)]
+        for child in self.children:
+            rows.extend(child.rows(path))
+        return rows
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_bytes": self.peak_bytes,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        span = cls(data["name"])
+        span.wall_seconds = data["wall_seconds"]
+        span.cpu_seconds = data["cpu_seconds"]
+        span.peak_bytes = data["peak_bytes"]
+        span.children = [cls.from_dict(child) for child in data["children"]]
+        return span
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _start_tracing():
+    global _tracing_roots, _started_tracing
+    with _tracing_lock:
+        if _tracing_roots == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_roots += 1
+
+
+def _stop_tracing():
+    # Leaves tracemalloc running if someone else started it
+    global _tracing_roots, _started_tracing
+    with _tracing_lock:
+        _tracing_roots -= 1
+        if _tracing_roots == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def _fold_peak(span):
+    # Record the peak reached since the last reset against this span
+    if span._traced_base is not None and tracemalloc.is_tracing():
+        span.peak_bytes = max(span.peak_bytes, tracemalloc.get_traced_memory()[1] - span._traced_base)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the enclosed block (or, as a decorator, each call) as a stage called name"""
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    current = Span(name)
+
+    root = parent is None
+    tracing = TRACE_MEMORY and (root or parent._traced_base is not None)
+    if tracing:
+        if root:
+            _start_tracing()
+        else:
+            _fold_peak(parent)
+        tracemalloc.reset_peak()
+        current._traced_base = tracemalloc.get_traced_memory()[0]
+
+    stack.append(current)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        current.wall_seconds = time.perf_counter() - wall_start
+        current.cpu_seconds = time.process_time() - cpu_start
+        stack.pop()
+        if tracing:
+            _fold_peak(current)
+            current.peak_bytes = max(current.peak_bytes, 0)
+            if root:
+                _stop_tracing()
+            else:
+                parent.peak_bytes = max(parent.peak_bytes,
+                                        current.peak_bytes + current._traced_base - parent._traced_base)
+                tracemalloc.reset_peak()
+        if parent is not None:
+            parent.children.append(current)
+        else:
+            logger.info(json.dumps({"event": "spans", **current.to_dict()}))
+
+
+def adopt(span_dicts):
+    """Attach spans recorded in worker processes (as Span.to_dict() output) to the open span"""
+    stack = _stack()
+    if stack:
+        stack[-1].children.extend(Span.from_dict(data) for data in span_dicts)
+
+
+def enable_logging(level=logging.INFO):
+    """Send span logs to stderr unless a handler is already configured"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+class StageStats:
+    """Recent wall times of every stage path, summarised as p50/p95"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.samples = {}
+
+    def add(self, root):
+        for _, path, stage in root.rows():
+            self.samples.setdefault(path, deque(maxlen=self.window)).append(stage.wall_seconds)
+
+    def summary(self):
+        return [
+            {
+                "stage": path,
+                "samples": len(times),
+                "p50_seconds": float(np.percentile(times, 50)),
+                "p95_seconds": float(np.percentile(times, 95)),
+            }
+            for path, times in self.samples.items()
+        ]
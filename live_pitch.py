@@ -0,0 +1,201 @@
+"""Low-latency pitch feedback for live practice.
+
+Microphone audio is processed in small frames as it arrives and compared with the
+reference contour at the current playback offset.
+
+Local stand-in for the microphone (replays a WAV file in real time):
+    python live_pitch.py "song refrence files/tum_hi(vocals extracted).mp3" my_take.wav
+"""
+import argparse
+import queue
+import time
+
+import numpy as np
+import soundfile
+
+from audio_analysis import HOP_LENGTH, PITCH_FMIN, PITCH_FMAX
+
+# Frames hold this many periods of the lowest sung pitch, so YIN can see its lag at any sample rate.
+# Rounded up to a power of two that is 512 samples (32 ms) at 16 kHz, 1024 (46 ms) at 22050 Hz and
+# 2048 (43 ms) at the 48 kHz streamlit-webrtc delivers, leaving room for processing within a ~100 ms
+# budget. Consecutive frames overlap by half.
+LIVE_FRAME_PERIODS = 2
+LIVE_HOP_FRACTION = 0.5
+# YIN aperiodicity threshold: frames whose best dip is above this are reported as unvoiced
+YIN_THRESHOLD = 0.15
+# Frames quieter than this RMS are skipped without running YIN
+LIVE_SILENCE_RMS = 0.01
+
+
+def yin_pitch(frame, sr, fmin=PITCH_FMIN, fmax=PITCH_FMAX, threshold=YIN_THRESHOLD):
+    """Estimate the pitch of a single frame with YIN, returning 0.0 when it is unvoiced"""
+    frame = np.asarray(frame, dtype=np.float64)
+    frame = frame - np.mean(frame)
+    max_lag = min(int(sr / fmin), len(frame) // 2)
+    min_lag = max(int(sr / fmax), 2)
+    window = len(frame) - max_lag
+    if window <= 0 or min_lag >= max_lag:
+        return 0.0
+
+    # Difference function d(tau) = e(0) + e(tau) - 2 r(tau), with the correlation r from one FFT
+    n_fft = 1 << int(np.ceil(np.log2(len(frame) + window)))
+    spectrum = np.fft.rfft(frame, n_fft) * np.conj(np.fft.rfft(frame[:window], n_fft))
+    correlation = np.fft.irfft(spectrum, n_fft)[:max_lag + 1]
+    energy = np.concatenate([[0.0], np.cumsum(frame ** 2)])
+    lag_energy = energy[window:window + max_lag + 1] - energy[:max_lag + 1]
+    difference = energy[window] + lag_energy - 2 * correlation
+    difference[0] = 0.0
+
+    # Cumulative mean normalized difference
+    cumulative = np.cumsum(difference[1:])
+    normalized = np.ones(max_lag + 1)
+    normalized[1:] = difference[1:] * np.arange(1, max_lag + 1) / np.maximum(cumulative, 1e-12)
+
+    # First dip below the threshold, then follow it down to its local minimum
+    candidates = np.flatnonzero(normalized[min_lag:max_lag] < threshold)
+    if len(candidates) == 0:
+        return 0.0
+    lag = min_lag + candidates[0]
+    while lag + 1 < max_lag and normalized[lag + 1] < normalized[lag]:
+        lag += 1
+
+    # Parabolic interpolation around the minimum for sub-sample accuracy
+    left, centre, right = normalized[lag - 1], normalized[lag], normalized[lag + 1]
+    denominator = left - 2 * centre + right
+    shift = 0.5 * (left - right) / denominator if denominator != 0 else 0.0
+    return sr / (lag + shift)
+
+
+def live_frame_length(sr):
+    """Samples per live frame at a sample rate: LIVE_FRAME_PERIODS periods of PITCH_FMIN, as a power of two"""
+    return 1 << int(np.ceil(np.log2(LIVE_FRAME_PERIODS * sr / PITCH_FMIN)))
+
+
+class IncrementalPitchTracker:
+    """Buffers incoming audio and emits one pitch estimate per hop"""
+
+    def __init__(self, sr, frame_length=None, hop_length=None):
+        self.sr = sr
+        self.frame_length = frame_length or live_frame_length(sr)
+        self.hop_length = hop_length or int(self.frame_length * LIVE_HOP_FRACTION)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.samples_seen = 0
+
+    def push(self, samples):
+        """Add mono samples; returns a list of (time in seconds, pitch in Hz) for completed frames"""
+        self.buffer = np.concatenate([self.buffer, np.asarray(samples, dtype=np.float32)])
+        estimates = []
+        while len(self.buffer) >= self.frame_length:
+            frame = self.buffer[:self.frame_length]
+            # Time stamp at the frame centre, matching the reference's centred frames
+            frame_time = (self.samples_seen + self.frame_length / 2) / self.sr
+            if np.sqrt(np.mean(frame ** 2)) < LIVE_SILENCE_RMS:
+                pitch = 0.0
+            else:
+                pitch = yin_pitch(frame, self.sr)
+            estimates.append((frame_time, pitch))
+            self.buffer = self.buffer[self.hop_length:]
+            self.samples_seen += self.hop_length
+        return estimates
+
+
+class LiveFeedback:
+    """Compares live pitch estimates with the reference contour at the playback offset"""
+
+    def __init__(self, ref_pitch, ref_sr, hop_length=HOP_LENGTH, window_frames=2):
+        self.ref_pitch = np.asarray(ref_pitch)
+        self.frame_rate = ref_sr / hop_length
+        self.window_frames = window_frames
+
+    def reference_pitch_at(self, offset):
+        """Median voiced reference pitch around a playback offset in seconds, or 0.0 if unvoiced"""
+        centre = int(round(offset * self.frame_rate))
+        start = max(centre - self.window_frames, 0)
+        window = self.ref_pitch[start:centre + self.window_frames + 1]
+        voiced = window[window > 0]
+        return float(np.median(voiced)) if len(voiced) else 0.0
+
+    def reading(self, offset, pitch):
+        """Cents off the reference at an offset (positive = sharp); None when either side is unvoiced"""
+        ref_pitch = self.reference_pitch_at(offset)
+        cents = 1200 * np.log2(pitch / ref_pitch) if pitch > 0 and ref_pitch > 0 else None
+        return {'time': offset, 'pitch': pitch, 'reference_pitch': ref_pitch, 'cents': cents}
+
+
+def wav_mic_stream(path, block_seconds=0.02, realtime=True):
+    """Replay an audio file (path or buffer) as if it were a microphone, yielding (mono samples, sr) blocks"""
+    sr = soundfile.info(path).samplerate
+    if hasattr(path, "seek"):
+        path.seek(0)
+    block_size = max(1, int(block_seconds * sr))
+    start = time.perf_counter()
+    delivered = 0
+    for block in soundfile.blocks(path, blocksize=block_size, dtype='float32', always_2d=True):
+        delivered += len(block)
+        if realtime:
+            # A real microphone delivers a block only once it has been recorded
+            delay = delivered / sr - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        yield block.mean(axis=1), sr
+
+
+def webrtc_mic_stream(webrtc_ctx, timeout=1.0):
+    """Yield (mono samples, sr) blocks from a streamlit-webrtc audio receiver while it is playing"""
+    while webrtc_ctx.state.playing:
+        try:
+            frames = webrtc_ctx.audio_receiver.get_frames(timeout=timeout)
+        except queue.Empty:
+            continue
+        for frame in frames:
+            # av.AudioFrame holds interleaved 16-bit samples
+            channels = len(frame.layout.channels)
+            samples = frame.to_ndarray().reshape(-1, channels).astype(np.float32) / 32768.0
+            yield samples.mean(axis=1), frame.sample_rate
+
+
+def run_live_session(mic_blocks, feedback, on_reading):
+    """Feed microphone blocks through a tracker and report each reading with its processing latency"""
+    tracker = None
+    for samples, sr in mic_blocks:
+        if tracker is None:
+            tracker = IncrementalPitchTracker(sr)
+        received = time.perf_counter()
+        for offset, pitch in tracker.push(samples):
+            reading = feedback.reading(offset, pitch)
+            reading['latency_ms'] = (time.perf_counter() - received) * 1000
+            on_reading(reading)
+
+
+def main():
+    from audio_analysis import load_audio, analysis_params, extract_features
+    from feature_cache import FeatureCache
+
+    parser = argparse.ArgumentParser(description="Replay a take as a live microphone and print pitch feedback")
+    parser.add_argument("reference", help="Reference song")
+    parser.add_argument("take", help="WAV file replayed as the microphone")
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible instead of in real time")
+    args = parser.parse_args()
+
+    with open(args.reference, "rb") as f:
+        ref_bytes = f.read()
+    ref_audio, ref_sr = load_audio(ref_bytes)
+    ref_features = FeatureCache().get_or_compute(ref_bytes, analysis_params(ref_sr),
+                                                 lambda: extract_features(ref_audio, ref_sr))
+    feedback = LiveFeedback(ref_features['pitch'], ref_sr)
+
+    latencies = []
+
+    def show(reading):
+        latencies.append(reading['latency_ms'])
+        cents = f"{reading['cents']:+7.1f} cents" if reading['cents'] is not None else "      --     "
+        print(f"{reading['time']:7.2f} s  {reading['pitch']:7.1f} Hz  {cents}  ({reading['latency_ms']:.1f} ms)")
+
+    run_live_session(wav_mic_stream(args.take, realtime=not args.fast), feedback, show)
+    if latencies:
+        print(f"\nprocessing latency p50 {np.percentile(latencies, 50):.1f} ms, "
+              f"p95 {np.percentile(latencies, 95):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
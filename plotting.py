@@ -0,0 +1,169 @@
+"""Lightweight rendering of the analysis plots.
+
+Waveforms are reduced to a min/max envelope per pixel column and the pitch and RMS series are averaged
+down to the same width before anything is drawn, so rendering cost no longer grows with clip length.
+The reduced data can be drawn as a PNG with matplotlib or described as an interactive Vega-Lite chart.
+"""
+import hashlib
+import io
+
+import numpy as np
+from matplotlib.figure import Figure
+
+from alignment import reference_to_user_index
+from audio_analysis import HOP_LENGTH
+
+# Horizontal resolution of the plots: a 10 inch figure at 100 dpi
+PLOT_COLUMNS = 1000
+REFERENCE_COLOR = "#1f77b4"
+USER_COLOR = "#d62728"
+
+
+def waveform_envelope(audio, sr, columns=PLOT_COLUMNS):
+    """Column-centre times and the minimum and maximum sample of each column"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if len(audio) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    bucket = max(1, int(np.ceil(len(audio) / columns)))
+    starts = np.arange(0, len(audio), bucket)
+    sizes = np.diff(np.append(starts, len(audio)))
+    return (starts + sizes / 2) / sr, np.minimum.reduceat(audio, starts), np.maximum.reduceat(audio, starts)
+
+
+def decimate_series(times, values, max_points=PLOT_COLUMNS):
+    """Average a series into at most max_points buckets, skipping NaN samples (NaN where a bucket has none)"""
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    bucket = max(1, int(np.ceil(len(values) / max_points)))
+    if bucket == 1:
+        return times, values
+    starts = np.arange(0, len(values), bucket)
+    sizes = np.diff(np.append(starts, len(values)))
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    means = np.full(len(starts), np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return np.add.reduceat(times, starts) / sizes, means
+
+
+def _voiced_or_nan(pitch):
+    # Unvoiced frames become gaps in the contour instead of drops to 0 Hz
+    pitch = np.asarray(pitch, dtype=np.float64)
+    return np.where(pitch > 0, pitch, np.nan)
+
+
+def prepare_plot_data(ref_audio, ref_sr, user_audio, user_sr, ref_features, user_features, alignment_path=None,
+                      hop_length=HOP_LENGTH, columns=PLOT_COLUMNS):
+    """Reduce both clips and their features to what the three plot panels draw.
+
+    With an alignment path, the user's pitch is warped onto the reference timeline.
+    """
+    ref_pitch = np.asarray(ref_features['pitch'])
+    user_pitch = np.asarray(user_features['pitch'])
+    if alignment_path is not None:
+        user_pitch = user_pitch[reference_to_user_index(alignment_path, len(ref_pitch))]
+        n_pitch = len(user_pitch)
+    else:
+        n_pitch = min(len(ref_pitch), len(user_pitch))
+    pitch_times = np.arange(n_pitch) * hop_length / ref_sr
+
+    n_rms = min(len(ref_features['rms']), len(user_features['rms']))
+    ref_rms_times = np.arange(n_rms) * hop_length / ref_sr
+    user_rms_times = np.arange(n_rms) * hop_length / user_sr
+
+    return {
+        'ref_waveform': waveform_envelope(ref_audio, ref_sr, columns),
+        'user_waveform': waveform_envelope(user_audio, user_sr, columns),
+        'ref_pitch': decimate_series(pitch_times, _voiced_or_nan(ref_pitch[:n_pitch]), columns),
+        'user_pitch': decimate_series(pitch_times, _voiced_or_nan(user_pitch[:n_pitch]), columns),
+        'ref_rms': decimate_series(ref_rms_times, ref_features['rms'][:n_rms], columns),
+        'user_rms': decimate_series(user_rms_times, user_features['rms'][:n_rms], columns),
+    }
+
+
+def plot_data_key(plot_data):
+    """Content hash of reduced plot data, used to cache the rendered charts"""
+    digest = hashlib.sha256()
+    for name in sorted(plot_data):
+        digest.update(name.encode())
+        for array in plot_data[name]:
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def render_png(plot_data):
+    """Draw the waveform, pitch and volume panels and return them as PNG bytes"""
+    # A bare Figure keeps no pyplot state, so concurrent sessions can render safely
+    fig = Figure(figsize=(10, 12))
+    axes = fig.subplots(3, 1)
+
+    axes[0].set_title('Audio Waveforms')
+    for name, label, color in (('ref_waveform', 'Reference', REFERENCE_COLOR),
+                               ('user_waveform', 'Your Singing', USER_COLOR)):
+        times, lows, highs = plot_data[name]
+        axes[0].fill_between(times, lows, highs, color=color, alpha=0.6, linewidth=0, label=label)
+    axes[0].legend(loc='upper right')
+
+    axes[1].set_title('Pitch Contours')
+    axes[1].plot(*plot_data['ref_pitch'], label='Reference Pitch', color=REFERENCE_COLOR, alpha=0.7)
+    axes[1].plot(*plot_data['user_pitch'], label='Your Pitch', color=USER_COLOR, alpha=0.7)
+    axes[1].set_ylabel('Frequency (Hz)')
+    axes[1].legend(loc='upper right')
+
+    axes[2].set_title('Volume (RMS Energy)')
+    axes[2].plot(*plot_data['ref_rms'], label='Reference Volume', color=REFERENCE_COLOR, alpha=0.7)
+    axes[2].plot(*plot_data['user_rms'], label='Your Volume', color=USER_COLOR, alpha=0.7)
+    axes[2].set_ylabel('RMS Energy')
+    axes[2].set_xlabel('Time (seconds)')
+    axes[2].legend(loc='upper right')
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def _rows(series, columns, **fields):
+    # Vega-Lite data rows; NaN becomes null so lines break at unvoiced frames
+    rows = []
+    for row in zip(*series):
+        values = {name: None if np.isnan(value) else round(float(value), 6) for name, value in zip(columns, row)}
+        rows.append({**fields, **values})
+    return rows
+
+
+def vega_lite_spec(plot_data):
+    """Interactive Vega-Lite version of the three panels, with the reduced data inlined"""
+    color = {"field": "source", "type": "nominal", "title": None,
+             "scale": {"domain": ["Reference", "Your Singing"], "range": [REFERENCE_COLOR, USER_COLOR]}}
+    time_axis = {"field": "time", "type": "quantitative", "title": "Time (seconds)"}
+
+    def panel(name, title, mark, rows, y):
+        # Drag to zoom and pan along the time axis
+        return {"title": title, "width": "container", "height": 220, "data": {"values": rows},
+                "params": [{"name": f"{name}_zoom", "select": {"type": "interval", "encodings": ["x"]},
+                            "bind": "scales"}],
+                "mark": mark, "encoding": {"x": time_axis, "color": color, **y}}
+
+    waveform_rows = (_rows(plot_data['ref_waveform'], ("time", "low", "high"), source="Reference")
+                     + _rows(plot_data['user_waveform'], ("time", "low", "high"), source="Your Singing"))
+    pitch_rows = (_rows(plot_data['ref_pitch'], ("time", "value"), source="Reference")
+                  + _rows(plot_data['user_pitch'], ("time", "value"), source="Your Singing"))
+    rms_rows = (_rows(plot_data['ref_rms'], ("time", "value"), source="Reference")
+                + _rows(plot_data['user_rms'], ("time", "value"), source="Your Singing"))
+
+    return {
+        "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
+        "vconcat": [
+            panel("waveform", "Audio Waveforms", {"type": "area", "opacity": 0.6}, waveform_rows,
+                  {"y": {"field": "low", "type": "quantitative", "title": "Amplitude"},
+                   "y2": {"field": "high"}}),
+            panel("pitch", "Pitch Contours", {"type": "line", "opacity": 0.7}, pitch_rows,
+                  {"y": {"field": "value", "type": "quantitative", "title": "Frequency (Hz)",
+                         "scale": {"zero": False}}}),
+            panel("rms", "Volume (RMS Energy)", {"type": "line", "opacity": 0.7}, rms_rows,
+                  {"y": {"field": "value", "type": "quantitative", "title": "RMS Energy"}}),
+        ],
+        "resolve": {"scale": {"color": "shared"}},
+    }
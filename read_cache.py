@@ -0,0 +1,62 @@
+"""Per-user cache of Firestore reads for one browser session.
+
+Streamlit reruns the whole script on every interaction, so pages that read Firestore directly repeat
+the same reads each time the user switches page in the sidebar. Entries here expire after a TTL, so
+changes made elsewhere (another device, a rebuild) still show up, and the app's own writes update or
+drop the entries they affect as they are made.
+"""
+import time
+
+READ_CACHE_TTL_SECONDS = 300.0
+
+
+class ReadCache:
+    """Values keyed by user ID and a name, each kept for at most ttl seconds"""
+
+    def __init__(self, ttl=READ_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.clock() - entry[0] >= self.ttl:
+            del self.entries[key]
+            return None
+        return entry
+
+    def get(self, user_id, name, load, store=True):
+        """Cached value, or the result of load() (kept for later unless store is False)"""
+        entry = self._fresh((user_id, name))
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = load()
+        if store:
+            self.put(user_id, name, value)
+        return value
+
+    def put(self, user_id, name, value):
+        self.entries[(user_id, name)] = (self.clock(), value)
+
+    def update(self, user_id, name, change):
+        """Apply change() to a cached value in place; values not cached are left to the next read"""
+        entry = self._fresh((user_id, name))
+        if entry is not None:
+            change(entry[1])
+
+    def invalidate(self, user_id, *names):
+        """Drop a user's entries with these names, or all of them when no name is given.
+
+        A name also matches tuple names starting with it, e.g. 'analyses' drops every ('analyses', page).
+        """
+        for key in list(self.entries):
+            entry_user, entry_name = key
+            group = entry_name[0] if isinstance(entry_name, tuple) else entry_name
+            if entry_user == user_id and (not names or group in names or entry_name in names):
+                del self.entries[key]
@@ -0,0 +1,177 @@
+"""Server-side library of precomputed reference songs.
+
+Songs are ingested once, offline, and every array the analysis page needs (decoded audio,
+pitch contour, voiced mask, RMS, centroid, the other spectral features and the note
+segmentation) is stored as a .npy file that is opened memory-mapped at request time.
+
+Usage:
+    python reference_library.py ingest "song refrence files"
+    python reference_library.py list
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from audio_analysis import load_audio, analysis_params, extract_features, segment_notes, NOTES_VERSION
+
+DEFAULT_LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_library")
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+
+
+class ReferenceLibrary:
+    """Memory-mapped feature store of reference songs with an index by song ID and content hash"""
+
+    def __init__(self, root=DEFAULT_LIBRARY_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        self.index_mtime = None
+        self.index = {"songs": {}, "by_hash": {}}
+        self._refresh()
+
+    def songs(self):
+        """Metadata of every song analysed with the current parameters, sorted by title"""
+        self._refresh()
+        current = [song for song in self.index["songs"].values() if _is_current(song)]
+        return sorted(current, key=lambda song: song["title"].lower())
+
+    def find_by_hash(self, audio_hash):
+        """Song ID of a previously ingested file with these exact bytes, or None"""
+        return self.index["by_hash"].get(audio_hash)
+
+    def load(self, song_id):
+        """Return a song's metadata, audio and features; arrays are read-only memory maps"""
+        song = self.index["songs"][song_id]
+        song_dir = os.path.join(self.root, song_id)
+
+        def open_array(name):
+            return np.load(os.path.join(song_dir, f"{name}.npy"), mmap_mode="r")
+
+        return {
+            "metadata": song,
+            "audio": open_array("audio"),
+            "features": {name: open_array(name) for name in song["features"]},
+            "notes": {name: open_array(f"notes_{name}") for name in song["notes"]},
+            "source_path": os.path.join(song_dir, song["source_file"]),
+        }
+
+    def ingest(self, path, title=None):
+        """Analyse one audio file and add it to the library; returns its song ID"""
+        with open(path, "rb") as f:
+            audio_bytes = f.read()
+        audio_hash = hashlib.sha256(audio_bytes).hexdigest()
+
+        existing = self.find_by_hash(audio_hash)
+        if existing is not None and _is_current(self.index["songs"][existing]):
+            return existing
+
+        audio, sr = load_audio(audio_bytes)
+        if audio is None:
+            raise ValueError(f"Could not decode {path}")
+        features = extract_features(audio, sr)
+        notes = segment_notes(features["pitch"], sr)
+
+        title = title or os.path.splitext(os.path.basename(path))[0]
+        song_id = existing or f"{_slugify(title)}-{audio_hash[:8]}"
+        source_file = "source" + os.path.splitext(path)[1].lower()
+
+        # Build the song directory next to the library and swap it in once complete
+        os.makedirs(self.root, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=self.root, prefix=".ingest-")
+        try:
+            np.save(os.path.join(staging_dir, "audio.npy"), audio)
+            for name, value in features.items():
+                np.save(os.path.join(staging_dir, f"{name}.npy"), np.asarray(value))
+            for name, value in notes.items():
+                np.save(os.path.join(staging_dir, f"notes_{name}.npy"), value)
+            shutil.copyfile(path, os.path.join(staging_dir, source_file))
+
+            song_dir = os.path.join(self.root, song_id)
+            if os.path.exists(song_dir):
+                shutil.rmtree(song_dir)
+            os.replace(staging_dir, song_dir)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        self.index["songs"][song_id] = {
+            "song_id": song_id,
+            "title": title,
+            "hash": audio_hash,
+            "sr": int(sr),
+            "duration": len(audio) / sr,
+            "n_frames": len(features["pitch"]),
+            "n_notes": len(notes["onset"]),
+            "features": sorted(features),
+            "notes": sorted(notes),
+            "source_file": source_file,
+            "params": analysis_params(sr),
+            "notes_version": NOTES_VERSION,
+        }
+        self.index["by_hash"][audio_hash] = song_id
+        self._write_index()
+        return song_id
+
+    def _refresh(self):
+        # Pick up songs ingested by the CLI while the app is running
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            return
+        if mtime != self.index_mtime:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            self.index_mtime = mtime
+
+    def _write_index(self):
+        # Atomic replace so the app never reads a half-written index
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+        self.index_mtime = os.path.getmtime(self.index_path)
+
+
+def _is_current(song):
+    # Songs analysed with older parameters are hidden until they are ingested again
+    return song.get("params") == analysis_params(song["sr"]) and song.get("notes_version", 1) == NOTES_VERSION
+
+
+def _slugify(title):
+    return re.sub(r"[^a-z0-9]+", "-", title.lower()).strip("-") or "song"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the precomputed reference song library")
+    parser.add_argument("--library", default=os.environ.get("MELODY_MENTOR_LIBRARY_DIR", DEFAULT_LIBRARY_DIR),
+                        help="Library directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Analyse every song in a directory")
+    ingest_parser.add_argument("directory", help="Directory of .wav/.mp3 reference songs")
+    subparsers.add_parser("list", help="List the songs in the library")
+
+    args = parser.parse_args()
+    library = ReferenceLibrary(args.library)
+
+    if args.command == "ingest":
+        for name in sorted(os.listdir(args.directory)):
+            if not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            try:
+                song_id = library.ingest(os.path.join(args.directory, name))
+                print(f"{name} -> {song_id}")
+            except Exception as e:
+                print(f"Skipping {name}: {e}")
+    else:
+        for song in library.songs():
+            print(f"{song['song_id']:<40} {song['duration']:7.1f} s  {song['n_notes']:5d} notes  {song['title']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Scoring engine: every metric of one or more takes against a reference, in one vectorized pass.
+
+compare_takes in audio_analysis warps each take onto the reference timeline, so after warping every
+take has one frame per reference frame. stack_takes lays the takes out as (takes × frames) arrays,
+one per feature. score_frames then computes each metric for all takes at once with array
+operations along the frame axis. Note timing comes from the note-level comparison, which works on
+notes rather than frames.
+
+Feedback is chosen from bands rather than fixed if/else ladders. Each metric has band edges and one
+message per band. The defaults reproduce the previous ladders. calibrate_bands derives the edges
+from a set of scored takes instead: quantiles of what real singers reach. batch_score.py
+--calibrate writes such a table, and MELODY_MENTOR_FEEDBACK_BANDS loads one into the app.
+"""
+import json
+import os
+
+import numpy as np
+import scipy.ndimage
+
+# Frames sung within this many cents of the reference count as in tune
+IN_TUNE_CENTS = 50.0
+# Percentiles of the absolute cents error reported per take
+CENTS_PERCENTILES = (50, 90)
+# Vibrato: the contour minus its running median over this window (about two cycles at 6 Hz) is the
+# vibrato. Only windows that are fully voiced, with a deviation below VIBRATO_MAX_CENTS, are used,
+# which leaves out note changes. Below VIBRATO_MIN_EXTENT_CENTS the wobble is jitter, not vibrato,
+# and no rate is reported.
+VIBRATO_WINDOW_SECONDS = 0.3
+VIBRATO_MAX_CENTS = 150.0
+VIBRATO_MIN_EXTENT_CENTS = 10.0
+# RMS floor (about -100 dBFS) for the dynamics contour in dB
+DYNAMICS_FLOOR = 1e-5
+
+# Every scalar score_frames and score_takes produce, for savers and reports that list them
+SCORE_METRICS = ('pitch_deviation', 'cents_p50', 'cents_p90', 'in_tune_ratio', 'vibrato_rate', 'vibrato_extent',
+                 'vibrato_rate_error', 'vibrato_extent_error', 'onset_error', 'dynamics_correlation',
+                 'timbre_distance', 'rms_deviation', 'spectral_centroid_deviation')
+
+# Takes are ranked by their share of frames sung in tune, then by mean cents error
+RANKING_METRICS = (('in_tune_ratio', True), ('pitch_deviation', False))
+# Phrases for the best-take-per-phrase breakdown: voiced runs of the reference joined across gaps
+# shorter than PHRASE_GAP_SECONDS. Runs shorter than MIN_PHRASE_SECONDS join the phrase before them,
+# and phrases longer than MAX_PHRASE_SECONDS are split evenly.
+PHRASE_GAP_SECONDS = 0.6
+MIN_PHRASE_SECONDS = 1.0
+MAX_PHRASE_SECONDS = 12.0
+# A take only competes for a phrase if it was voiced over at least this share of the phrase's voiced
+# reference frames
+MIN_PHRASE_COVERAGE = 0.5
+
+# Feedback bands per metric. A value below edges[0] gets messages[0], below edges[1] messages[1], and
+# so on. With higher_is_better the edges run downwards and a value above an edge gets its message.
+# A message of None adds no feedback line for that band, and 'missing' is used when the metric could
+# not be computed.
+DEFAULT_FEEDBACK_BANDS = {
+    'pitch_deviation': {
+        'higher_is_better': False,
+        'edges': [50.0, 100.0, 200.0],
+        'messages': [
+            "Your pitch accuracy is excellent! You're staying very close to the original melody.",
+            "Your pitch is good but could use some fine-tuning. Try focusing on the more challenging note transitions.",
+            "Your pitch needs some work. Try singing with the reference audio and pay attention to the melody.",
+            "Your pitch needs significant improvement. Consider practicing with a piano or vocal warm-ups to improve your pitch accuracy.",
+        ],
+        'missing': "Could not compare pitch. Ensure both audios have clear vocal content.",
+    },
+    'rms_deviation': {
+        'higher_is_better': False,
+        'edges': [0.05, 0.1],
+        'messages': [
+            "Your volume control is excellent!",
+            "Your volume consistency is good. Minor adjustments needed for perfect dynamics.",
+            "Work on maintaining more consistent volume. Practice breath control for better volume regulation.",
+        ],
+    },
+    'spectral_centroid_deviation': {
+        'higher_is_better': False,
+        'edges': [200.0, 500.0],
+        'messages': [
+            "Your vocal tone/timbre matches the original very well!",
+            "Your vocal tone is fairly close to the original. Focus on vowel shapes to better match the timbre.",
+            "Your vocal timbre differs significantly from the reference. Experiment with different vocal techniques and resonance to match the original sound better.",
+        ],
+    },
+    'dynamics_correlation': {
+        'higher_is_better': True,
+        'edges': [0.5],
+        'messages': [
+            None,
+            "Your louder and softer passages don't follow the reference's. Mark where the song swells and fades and shape your phrases the same way.",
+        ],
+    },
+    'vibrato_extent_error': {
+        'higher_is_better': False,
+        'edges': [25.0],
+        'messages': [
+            None,
+            "Your vibrato is noticeably wider or narrower than the reference's. Listen to how much the held notes waver and match it.",
+        ],
+    },
+}
+# Metrics given feedback after the note-level messages, in this order
+TRAILING_FEEDBACK_METRICS = ('rms_deviation', 'spectral_centroid_deviation', 'dynamics_correlation',
+                             'vibrato_extent_error')
+# Band edges set by calibrate_bands, as the share of the scored population that should land in a
+# better band than each edge: a quarter of takes count as excellent pitch, and only the worst quarter
+# hear about their dynamics
+CALIBRATION_QUANTILES = {
+    'pitch_deviation': (0.25, 0.5, 0.75),
+    'rms_deviation': (0.33, 0.67),
+    'spectral_centroid_deviation': (0.33, 0.67),
+    'dynamics_correlation': (0.75,),
+    'vibrato_extent_error': (0.75,),
+}
+
+
+def stack_takes(ref_features, takes, unwarped=None):
+    """Reference and take features as arrays on the reference's frame grid.
+
+    Returns a dict of the reference's 'ref_pitch', 'ref_rms', 'ref_centroid' and 'ref_mfcc' and the
+    takes' 'pitch', 'rms', 'centroid' and 'mfcc' with a leading takes axis, plus 'valid', marking the
+    frames each take covers. Takes should already be warped onto the reference timeline. Shorter takes
+    are padded, and their missing frames are left out of every metric.
+
+    'own_pitch' holds each take's pitch on its own timeline, zero-padded, from unwarped (the takes
+    before warping) when given. Warping repeats and skips frames, so vibrato is measured on these.
+    """
+    n_frames = len(ref_features['pitch'])
+    n_takes = len(takes)
+    ref_mfcc = np.asarray(ref_features['mfcc'], dtype=np.float64)
+    stacked = {
+        'ref_pitch': np.asarray(ref_features['pitch'], dtype=np.float64),
+        'ref_rms': np.asarray(ref_features['rms'], dtype=np.float64),
+        'ref_centroid': np.asarray(ref_features['spectral_centroid'], dtype=np.float64),
+        'ref_mfcc': ref_mfcc,
+        'valid': np.zeros((n_takes, n_frames), dtype=bool),
+        'pitch': np.zeros((n_takes, n_frames)),
+        'rms': np.zeros((n_takes, n_frames)),
+        'centroid': np.zeros((n_takes, n_frames)),
+        'mfcc': np.zeros((n_takes,) + ref_mfcc.shape),
+    }
+    for i, take in enumerate(takes):
+        length = min(n_frames, len(take['pitch']))
+        stacked['valid'][i, :length] = True
+        stacked['pitch'][i, :length] = take['pitch'][:length]
+        stacked['rms'][i, :length] = take['rms'][:length]
+        stacked['centroid'][i, :length] = take['spectral_centroid'][:length]
+        stacked['mfcc'][i, :, :length] = np.asarray(take['mfcc'])[..., :length]
+
+    own = [take['pitch'] for take in (unwarped if unwarped is not None else takes)]
+    stacked['own_pitch'] = np.zeros((n_takes, max((len(pitch) for pitch in own), default=0)))
+    for i, pitch in enumerate(own):
+        stacked['own_pitch'][i, :len(pitch)] = pitch
+    return stacked
+
+
+def _masked_mean(values, mask):
+    # Mean along the frame axis over the masked frames; NaN for rows with none
+    count = mask.sum(axis=-1)
+    total = np.where(mask, values, 0.0).sum(axis=-1)
+    return np.divide(total, count, out=np.full(total.shape, np.nan), where=count > 0)
+
+
+def vibrato(pitch, sr, hop_length):
+    """Vibrato rate (Hz) and extent (cents, half the peak-to-peak swing) of each row of pitch contours"""
+    pitch = np.atleast_2d(pitch)
+    voiced = pitch > 0
+    cents = np.zeros(pitch.shape)
+    cents[voiced] = 1200 * np.log2(pitch[voiced] / 440.0)
+
+    window = max(3, int(round(VIBRATO_WINDOW_SECONDS * sr / hop_length)) | 1)
+    trend = scipy.ndimage.median_filter(cents, size=(1, window), mode='nearest')
+    residual = cents - trend
+    steady = scipy.ndimage.uniform_filter1d(voiced.astype(np.float64), window, axis=1, mode='constant') > 1 - 1e-9
+    steady &= np.abs(residual) < VIBRATO_MAX_CENTS
+
+    # A sinusoid of amplitude A has an RMS of A / sqrt(2)
+    extent = np.sqrt(2 * _masked_mean(residual ** 2, steady))
+    # Each cycle crosses its centre twice
+    crossings = (steady[:, 1:] & steady[:, :-1] & (np.signbit(residual[:, 1:]) != np.signbit(residual[:, :-1])))
+    seconds = steady.sum(axis=1) * hop_length / sr
+    rate = np.divide(crossings.sum(axis=1) / 2, seconds, out=np.full(len(pitch), np.nan), where=seconds > 0)
+    rate[~(extent >= VIBRATO_MIN_EXTENT_CENTS)] = np.nan
+    return rate, extent
+
+
+def _cents_error(stacked):
+    # Absolute pitch error in cents over the frames voiced in both, NaN elsewhere, and that mask
+    ref_pitch, pitch = stacked['ref_pitch'], stacked['pitch']
+    both_voiced = stacked['valid'] & (ref_pitch > 0) & (pitch > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        abs_cents = np.where(both_voiced, np.abs(1200 * np.log2(pitch / ref_pitch)), np.nan)
+    return abs_cents, both_voiced
+
+
+def score_frames(stacked, sr, hop_length):
+    """Frame-level metrics of every stacked take at once; each value is an array with one entry per take (NaN
+    where a metric is undefined)"""
+    valid = stacked['valid']
+    ref_pitch = stacked['ref_pitch']
+
+    abs_cents, both_voiced = _cents_error(stacked)
+    scores = {'pitch_deviation': _masked_mean(abs_cents, both_voiced),
+              'in_tune_ratio': _masked_mean(abs_cents < IN_TUNE_CENTS, both_voiced)}
+    # Percentiles per take: sorted rows with the NaNs last, indexed at each row's own count
+    counts = both_voiced.sum(axis=1)
+    ordered = np.sort(abs_cents, axis=1)
+    for q in CENTS_PERCENTILES:
+        position = np.clip(q / 100 * (counts - 1), 0, None)
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, np.maximum(counts - 1, 0))
+        rows = np.arange(len(ordered))
+        value = ordered[rows, low] + (ordered[rows, high] - ordered[rows, low]) * (position - low)
+        scores[f'cents_p{q}'] = np.where(counts > 0, value, np.nan)
+
+    # Vibrato belongs to each recording alone, so the takes' is measured on their own timelines
+    ref_rate, ref_extent = vibrato(ref_pitch, sr, hop_length)
+    rates, extents = vibrato(stacked['own_pitch'], sr, hop_length)
+    scores['vibrato_rate'], scores['vibrato_extent'] = rates, extents
+    scores['vibrato_rate_error'] = np.abs(rates - ref_rate)
+    scores['vibrato_extent_error'] = np.abs(extents - ref_extent)
+
+    # Dynamics: Pearson correlation of the loudness contours in dB
+    ref_db = 20 * np.log10(np.maximum(stacked['ref_rms'], DYNAMICS_FLOOR))
+    db = 20 * np.log10(np.maximum(stacked['rms'], DYNAMICS_FLOOR))
+    ref_centred = np.where(valid, ref_db - _masked_mean(np.broadcast_to(ref_db, db.shape), valid)[:, None], 0.0)
+    centred = np.where(valid, db - _masked_mean(db, valid)[:, None], 0.0)
+    spread = np.sqrt((ref_centred ** 2).sum(axis=1) * (centred ** 2).sum(axis=1))
+    scores['dynamics_correlation'] = np.divide((ref_centred * centred).sum(axis=1), spread,
+                                               out=np.full(len(db), np.nan), where=spread > 0)
+
+    # Timbre: distance between MFCC frames where both sing, without c0 (overall loudness)
+    mfcc_distance = np.sqrt(((stacked['mfcc'][:, 1:] - stacked['ref_mfcc'][1:]) ** 2).sum(axis=1))
+    scores['timbre_distance'] = _masked_mean(mfcc_distance, both_voiced)
+
+    # Mean absolute volume and brightness differences, as the streamed comparison also reports them
+    scores['rms_deviation'] = _masked_mean(np.abs(stacked['rms'] - stacked['ref_rms']), valid)
+    scores['spectral_centroid_deviation'] = _masked_mean(np.abs(stacked['centroid'] - stacked['ref_centroid']), valid)
+    return scores
+
+
+def score_takes(ref_features, takes, sr, hop_length, note_comparisons=None, unwarped=None):
+    """Scores of each take against the reference, as one dict of plain floats (None when undefined) per take.
+
+    takes must already be on the reference timeline; pass the takes before warping as unwarped so
+    vibrato is measured on their own timing. note_comparisons, one compare_notes() result per take,
+    add the median onset error of the matched notes in seconds.
+    """
+    scores = score_frames(stack_takes(ref_features, takes, unwarped), sr, hop_length)
+    if note_comparisons is not None:
+        scores['onset_error'] = np.array([
+            np.nanmedian(np.abs(notes['note_onset_error'])) if notes['notes_matched'] else np.nan
+            for notes in note_comparisons
+        ])
+    return [
+        {name: (float(values[i]) if np.isfinite(values[i]) else None) for name, values in scores.items()}
+        for i in range(len(takes))
+    ]
+
+
+def rank_takes(scores):
+    """Indices of the takes, best first, from their score dicts; takes missing a metric rank below those with it"""
+    def key(index):
+        ranking = []
+        for name, higher_is_better in RANKING_METRICS:
+            value = scores[index].get(name)
+            ranking.append(np.inf if value is None else -value if higher_is_better else value)
+        return ranking
+    return sorted(range(len(scores)), key=key)
+
+
+def phrase_starts(ref_pitch, sr, hop_length):
+    """First frame of each phrase of the reference; a phrase runs until the next one starts"""
+    voiced = np.asarray(ref_pitch) > 0
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], voiced.astype(np.int8), [0]))))
+    starts, stops = edges[::2], edges[1::2]
+    if len(starts) == 0:
+        return np.array([0])
+
+    # Join runs across short gaps, then fold short phrases into the one before
+    gap_frames = PHRASE_GAP_SECONDS * sr / hop_length
+    keep = np.concatenate(([True], starts[1:] - stops[:-1] >= gap_frames))
+    starts = starts[keep]
+    stops = np.append(stops[np.flatnonzero(keep)[1:] - 1], stops[-1])
+    long_enough = stops - starts >= MIN_PHRASE_SECONDS * sr / hop_length
+    long_enough[0] = True
+    starts, stops = starts[long_enough], np.append(stops[np.flatnonzero(long_enough)[1:] - 1], stops[-1])
+
+    max_frames = MAX_PHRASE_SECONDS * sr / hop_length
+    split = [np.linspace(start, stop, int(np.ceil((stop - start) / max_frames)), endpoint=False).astype(int)
+             for start, stop in zip(starts, stops)]
+    return np.concatenate(split)
+
+
+def best_by_phrase(ref_features, takes, sr, hop_length):
+    """Mean cents error of every take over every phrase of the reference, and the best take per phrase.
+
+    takes must already be on the reference timeline. Returns 'start' and 'end' (seconds), 'cents', a
+    (takes x phrases) array with NaN where a take didn't sing enough of a phrase, and 'best', the index
+    of the take with the lowest error per phrase, or -1 when no take qualifies.
+    """
+    stacked = stack_takes(ref_features, takes)
+    abs_cents, both_voiced = _cents_error(stacked)
+    n_frames = len(stacked['ref_pitch'])
+    starts = phrase_starts(stacked['ref_pitch'], sr, hop_length)
+
+    # Per-phrase sums along the frame axis for every take at once
+    totals = np.add.reduceat(np.where(both_voiced, abs_cents, 0.0), starts, axis=1)
+    counts = np.add.reduceat(both_voiced, starts, axis=1)
+    ref_counts = np.add.reduceat(stacked['ref_pitch'] > 0, starts)
+    covered = counts >= MIN_PHRASE_COVERAGE * np.maximum(ref_counts, 1)
+    cents = np.divide(totals, counts, out=np.full(totals.shape, np.nan), where=covered & (counts > 0))
+
+    best = np.full(len(starts), -1)
+    sung = ~np.all(np.isnan(cents), axis=0)
+    best[sung] = np.nanargmin(cents[:, sung], axis=0)
+    ends = np.append(starts[1:], n_frames)
+    return {'start': starts * hop_length / sr, 'end': ends * hop_length / sr, 'cents': cents, 'best': best}
+
+
+def feedback_bands():
+    """The feedback bands in use: a calibrated table from MELODY_MENTOR_FEEDBACK_BANDS, else the defaults"""
+    path = os.environ.get('MELODY_MENTOR_FEEDBACK_BANDS')
+    if not path:
+        return DEFAULT_FEEDBACK_BANDS
+    with open(path) as f:
+        calibrated = json.load(f)
+    # Calibration only moves edges; messages and metrics it doesn't cover keep their defaults
+    return {name: {**band, 'edges': calibrated.get(name, band['edges'])}
+            for name, band in DEFAULT_FEEDBACK_BANDS.items()}
+
+
+def band_message(name, value, bands=None):
+    """Feedback line for one metric's value, or None"""
+    band = (bands or DEFAULT_FEEDBACK_BANDS).get(name)
+    if band is None:
+        return None
+    if value is None:
+        return band.get('missing')
+    if band['higher_is_better']:
+        index = int(np.sum(value <= np.asarray(band['edges'])))
+    else:
+        index = int(np.sum(value >= np.asarray(band['edges'])))
+    return band['messages'][index]
+
+
+def calibrate_bands(results, quantiles=None):
+    """Band edges from a population of scored takes (dicts of metric values), at CALIBRATION_QUANTILES"""
+    quantiles = quantiles or CALIBRATION_QUANTILES
+    edges = {}
+    for name, qs in quantiles.items():
+        values = np.array([r[name] for r in results if r.get(name) is not None], dtype=np.float64)
+        if len(values) == 0:
+            continue
+        if DEFAULT_FEEDBACK_BANDS[name]['higher_is_better']:
+            edges[name] = [float(v) for v in np.quantile(values, [1 - q for q in qs])]
+        else:
+            edges[name] = [float(v) for v in np.quantile(values, qs)]
+    return edges
@@ -0,0 +1,105 @@
+"""Vocal isolation for reference tracks that are full mixes.
+
+On a mix, PYIN weighs the instruments' pitch candidates as well as the voice's, and the melody it
+settles on is often the guitar's. Separating the vocals first gives it the voice alone. The stem also
+falls silent in instrumental breaks, so the voice-activity pre-pass can skip them.
+
+Two CPU-only methods are offered, both built on librosa:
+
+- 'repet_sim' (REPET-SIM). Each spectrogram frame is compared with the most similar frames elsewhere
+  in the song. Whatever those frames share is treated as accompaniment, and a soft mask keeps the
+  rest, which is mostly the voice.
+- 'hpss' (two-stage harmonic/percussive separation). A long median filter removes sustained
+  instruments. A short one then takes the drums out of what is left.
+
+Separation costs several seconds per minute of audio. The stem is cached in the FeatureCache, keyed
+by the reference bytes and these parameters, so a song is separated once, however many takes are
+compared with it.
+"""
+import librosa
+import numpy as np
+
+SEPARATION_METHODS = ('repet_sim', 'hpss')
+DEFAULT_SEPARATION_METHOD = 'repet_sim'
+# Bump whenever isolate_vocals changes its output so cached stems are recomputed
+SEPARATION_VERSION = 1
+# STFT used for separation. At the 16 kHz analysis rate frames are 128 ms long, fine enough in
+# frequency to tell a voice's harmonics from the accompaniment's.
+SEPARATION_N_FFT = 2048
+SEPARATION_HOP_LENGTH = 512
+# REPET-SIM: frames compared with a frame must lie at least this far from it, so a held note is not
+# mistaken for repeating accompaniment
+REPET_SIM_WIDTH_SECONDS = 2.0
+# Soft-mask margins: the larger the margin, the more of a bin must stand out from the accompaniment
+# estimate before it is kept. Larger margins than 1 suppressed too much of the voice along with the
+# accompaniment (see `benchmark.py separation`).
+REPET_SIM_MARGIN = 1.0
+HPSS_MARGIN = 1.0
+MASK_POWER = 2
+# Two-stage HPSS median filter lengths, in seconds: sustained instruments are steadier than the
+# first, sung notes (vibrato, glides) steadier than the second
+HPSS_SUSTAINED_SECONDS = 1.0
+HPSS_VOCAL_SECONDS = 0.1
+
+
+def separation_params(sr, method=DEFAULT_SEPARATION_METHOD):
+    """Parameters that determine the separated stem, used to key cached stems and features"""
+    return {
+        'sr': int(sr),
+        'method': method,
+        'n_fft': SEPARATION_N_FFT,
+        'hop_length': SEPARATION_HOP_LENGTH,
+        'separation_version': SEPARATION_VERSION,
+        'librosa_version': librosa.__version__,
+    }
+
+
+def _repet_sim(S, sr):
+    # Accompaniment estimate: median of each frame's nearest neighbours by cosine similarity
+    width = max(1, int(librosa.time_to_frames(REPET_SIM_WIDTH_SECONDS, sr=sr, hop_length=SEPARATION_HOP_LENGTH)))
+    # The neighbours can't share a window with the frame, so very short clips keep everything
+    if S.shape[1] <= 2 * width + 1:
+        return np.ones_like(S)
+    background = np.minimum(S, librosa.decompose.nn_filter(S, aggregate=np.median, metric='cosine', width=width))
+    return librosa.util.softmask(S - background, REPET_SIM_MARGIN * background, power=MASK_POWER)
+
+
+def _hpss(S, sr):
+    def frames(seconds):
+        # Median filter lengths must be odd
+        return 2 * max(1, int(round(seconds * sr / SEPARATION_HOP_LENGTH / 2))) + 1
+
+    # Stage 1 takes out sustained instruments, stage 2 the drums from what is left
+    _, fluctuating_mask = librosa.decompose.hpss(S, kernel_size=(frames(HPSS_SUSTAINED_SECONDS), 31),
+                                                 margin=HPSS_MARGIN, power=MASK_POWER, mask=True)
+    vocal_mask, _ = librosa.decompose.hpss(S * fluctuating_mask, kernel_size=(frames(HPSS_VOCAL_SECONDS), 31),
+                                           margin=HPSS_MARGIN, power=MASK_POWER, mask=True)
+    return fluctuating_mask * vocal_mask
+
+
+SEPARATION_MASKS = {
+    'repet_sim': _repet_sim,
+    'hpss': _hpss,
+}
+
+
+def isolate_vocals(audio, sr, method=DEFAULT_SEPARATION_METHOD):
+    """Vocal stem of a mix: float32 PCM of the same length and rate"""
+    if method not in SEPARATION_MASKS:
+        raise ValueError(f"Unknown separation method '{method}'. Choose one of: {', '.join(SEPARATION_METHODS)}")
+    D = librosa.stft(audio, n_fft=SEPARATION_N_FFT, hop_length=SEPARATION_HOP_LENGTH)
+    S, phase = librosa.magphase(D)
+    mask = SEPARATION_MASKS[method](S, sr)
+    stem = librosa.istft(mask * S * phase, hop_length=SEPARATION_HOP_LENGTH, n_fft=SEPARATION_N_FFT,
+                         length=len(audio))
+    return stem.astype(np.float32)
+
+
+def cached_vocals(feature_cache, audio_bytes, sr, method=DEFAULT_SEPARATION_METHOD):
+    """The cached vocal stem of these reference bytes, or None on a miss"""
+    entry = feature_cache.get(feature_cache.key(audio_bytes, separation_params(sr, method)))
+    return entry['audio'] if entry is not None else None
+
+
+def cache_vocals(feature_cache, audio_bytes, sr, stem, method=DEFAULT_SEPARATION_METHOD):
+    feature_cache.put(feature_cache.key(audio_bytes, separation_params(sr, method)), {'audio': stem})